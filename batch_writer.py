@@ -0,0 +1,100 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, List, Tuple
+from pymongo.errors import BulkWriteError, WriteError, WriteConcernError
+
+# ===========================================
+# Escritura agrupada (group commit) de inserciones
+# ===========================================
+class GroupCommitWriter:
+    """Agrupa inserciones concurrentes de una colección en un solo insert_many.
+
+    Cada llamada a insert() encola el documento y espera su resultado. Un hilo
+    de fondo junta hasta max_docs documentos o espera como máximo max_delay_ms
+    desde el primero, los inserta con insert_many(ordered=False) y resuelve el
+    resultado de cada llamador con su propio _id o su propio error. El write
+    concern es el de la colección, igual que con insert_one.
+    """
+
+    def __init__(self, get_collection: Callable[[], Any], max_docs: int = 50, max_delay_ms: float = 5):
+        self._get_collection = get_collection
+        self.max_docs = max_docs
+        self.max_delay = max_delay_ms / 1000
+        self._queue: "queue.Queue[Tuple[Dict[str, Any], Future]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stats = {"batches": 0, "documents": 0, "errors": 0}
+
+    def insert(self, document: Dict[str, Any], timeout: float = 30) -> Any:
+        """Encola el documento y retorna su _id cuando el lote se confirma.
+        
+        Si el documento sigue en la cola después de timeout segundos se retira
+        (no se insertará) y se lanza TimeoutError; si su lote ya se está
+        insertando se espera el resultado.
+        """
+        self._ensure_thread()
+        future: Future = Future()
+        self._queue.put((document, future))
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            if future.cancel():
+                raise
+            return future.result()
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="group-commit-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_docs:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch: List[Tuple[Dict[str, Any], Future]]) -> None:
+        # Descartar los documentos cuyo llamador ya se rindió; los demás ya no se pueden cancelar
+        batch = [(document, future) for document, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        documents = [document for document, _ in batch]
+        self.stats["batches"] += 1
+        self.stats["documents"] += len(documents)
+        try:
+            # insert_many asigna el _id a cada documento antes de enviarlo
+            self._get_collection().insert_many(documents, ordered=False)
+            for document, future in batch:
+                future.set_result(document["_id"])
+        except BulkWriteError as e:
+            # Con ordered=False solo fallan los documentos con error; el resto quedó insertado
+            write_errors = {error["index"]: error for error in e.details.get("writeErrors", [])}
+            concern_errors = e.details.get("writeConcernErrors", [])
+            for index, (document, future) in enumerate(batch):
+                if index in write_errors:
+                    error = write_errors[index]
+                    self.stats["errors"] += 1
+                    future.set_exception(WriteError(error.get("errmsg"), error.get("code"), error))
+                elif concern_errors:
+                    self.stats["errors"] += 1
+                    future.set_exception(WriteConcernError(concern_errors[0].get("errmsg"),
+                                                           concern_errors[0].get("code"), concern_errors[0]))
+                else:
+                    future.set_result(document["_id"])
+        except Exception as e:
+            self.stats["errors"] += len(batch)
+            for _, future in batch:
+                future.set_exception(e)
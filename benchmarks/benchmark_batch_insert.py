@@ -0,0 +1,77 @@
+"""Benchmark de inserciones individuales vs. escritura agrupada (group commit).
+
+Simula N clientes concurrentes insertando citas contra la base de datos
+configurada en .env y reporta throughput y latencias (p50/p99) de insert_one
+frente a GroupCommitWriter con distintos tiempos máximos de espera. Usa una
+colección temporal que se elimina al terminar.
+
+Uso:
+    python benchmarks/benchmark_batch_insert.py [clientes] [inserciones_por_cliente]
+"""
+import os
+import sys
+import time
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import database
+from batch_writer import GroupCommitWriter
+
+COLECCION = "benchmark_batch_insert"
+
+def cita(i: int):
+    return {
+        "fecha_hora": datetime(2025, 9, 1, 8 + i % 10, (i * 20) % 60),
+        "motivo": "Control de rutina",
+        "id_paciente": i % 500 + 1,
+        "id_doctor": i % 20 + 1,
+        "created_at": datetime.utcnow(),
+        "version": 1
+    }
+
+def ejecutar(insertar, clientes: int, por_cliente: int):
+    """Retorna (documentos/s, p50 ms, p99 ms)"""
+    def cliente(numero: int):
+        latencias = []
+        for j in range(por_cliente):
+            inicio = time.perf_counter()
+            insertar(cita(numero * por_cliente + j))
+            latencias.append((time.perf_counter() - inicio) * 1000)
+        return latencias
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clientes) as executor:
+        latencias = [lat for resultado in executor.map(cliente, range(clientes)) for lat in resultado]
+    total = time.perf_counter() - inicio
+
+    latencias.sort()
+    return len(latencias) / total, statistics.median(latencias), latencias[int(len(latencias) * 0.99) - 1]
+
+def main():
+    clientes = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    por_cliente = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    if not database.get_connection():
+        sys.exit(1)
+    collection = database.get_collection(COLECCION)
+
+    print(f"{clientes} clientes x {por_cliente} inserciones")
+    print(f"{'modo':<26} {'docs/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    try:
+        docs_s, p50, p99 = ejecutar(lambda doc: collection.insert_one(doc), clientes, por_cliente)
+        print(f"{'insert_one':<26} {docs_s:>9.0f} {p50:>8.1f} {p99:>8.1f}")
+
+        for max_delay_ms in (1, 5, 10):
+            writer = GroupCommitWriter(lambda: collection, max_docs=database.BATCH_INSERT_MAX_DOCS, max_delay_ms=max_delay_ms)
+            docs_s, p50, p99 = ejecutar(writer.insert, clientes, por_cliente)
+            lote = writer.stats["documents"] / max(writer.stats["batches"], 1)
+            modo = f"group commit {max_delay_ms} ms (x{lote:.1f})"
+            print(f"{modo:<26} {docs_s:>9.0f} {p50:>8.1f} {p99:>8.1f}")
+    finally:
+        collection.drop()
+        database.close_connection()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Benchmark de compresión de respuestas para páginas típicas de listados.
+
+Genera páginas sintéticas con la forma de los documentos de la API (paciente,
+historial, cita) y reporta, por algoritmo y nivel, los bytes en la red, la
+razón de compresión y el tiempo de CPU por página.
+
+Uso:
+    python benchmarks/benchmark_compresion.py [documentos_por_pagina]
+"""
+import json
+import random
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+NOMBRES = ["Juan", "María", "Pedro", "Ana", "Luis", "Carlos", "Patricia", "Sofía"]
+APELLIDOS = ["Pérez", "González", "Sánchez", "Ramírez", "Torres", "García", "López"]
+TEXTOS = [
+    "Paciente refiere dolor torácico de intensidad moderada, sin irradiación, de dos días de evolución.",
+    "Se indica control en quince días, dieta baja en sodio y actividad física moderada.",
+    "Lesión cutánea eritematosa en antebrazo derecho, sin signos de infección secundaria.",
+    "Control pediátrico de rutina, crecimiento y desarrollo acordes a la edad."
+]
+
+def _object_id() -> str:
+    return "%024x" % random.getrandbits(96)
+
+def generar_pagina(entidad: str, cantidad: int):
+    """Genera una página de documentos como la retornan los endpoints de listado"""
+    base = datetime(2025, 9, 1, 8, 0)
+    documentos = []
+    for i in range(cantidad):
+        comunes = {
+            "_id": _object_id(),
+            "created_at": (base + timedelta(minutes=i)).isoformat(),
+            "updated_at": (base + timedelta(minutes=i)).isoformat(),
+            "version": 1
+        }
+        if entidad == "paciente":
+            documentos.append(dict(comunes,
+                nombre=random.choice(NOMBRES), apellido=random.choice(APELLIDOS),
+                fecha_nacimiento=f"19{random.randint(50, 99)}-0{random.randint(1, 9)}-1{random.randint(0, 9)}T00:00:00",
+                telefono=f"300{random.randint(1000000, 9999999)}",
+                email=f"usuario{i}@email.com", direccion=f"Calle {random.randint(1, 200)} #{random.randint(1, 99)}-{random.randint(1, 99)}"))
+        elif entidad == "historial":
+            documentos.append(dict(comunes,
+                fecha=(base + timedelta(days=i % 30)).date().isoformat(),
+                diagnostico=random.choice(TEXTOS), tratamiento=random.choice(TEXTOS),
+                observaciones=" ".join(random.sample(TEXTOS, 2)),
+                id_paciente=random.randint(1, 500), id_doctor=random.randint(1, 20)))
+        else:
+            documentos.append(dict(comunes,
+                fecha_hora=(base + timedelta(minutes=20 * i)).isoformat(),
+                motivo=random.choice(TEXTOS), id_paciente=random.randint(1, 500), id_doctor=random.randint(1, 20)))
+    return {"message": f"Lista de {entidad}", "data": documentos}
+
+def compresores():
+    """Algoritmos y niveles a comparar"""
+    opciones = [(f"gzip-{nivel}", lambda datos, nivel=nivel: zlib.compress(datos, nivel)) for nivel in (1, 6, 9)]
+    if zstandard is not None:
+        opciones += [
+            (f"zstd-{nivel}", lambda datos, nivel=nivel: zstandard.ZstdCompressor(level=nivel).compress(datos))
+            for nivel in (1, 3, 9)
+        ]
+    return opciones
+
+def medir(datos: bytes, comprimir, repeticiones: int = 50):
+    """Retorna (bytes comprimidos, ms de CPU por página)"""
+    inicio = time.process_time()
+    for _ in range(repeticiones):
+        resultado = comprimir(datos)
+    return len(resultado), (time.process_time() - inicio) * 1000 / repeticiones
+
+def main():
+    cantidad = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    random.seed(42)
+    if zstandard is None:
+        print("ℹ️  zstandard no está instalado: solo se mide gzip")
+
+    print(f"{'entidad':<10} {'algoritmo':<9} {'bytes':>9} {'razón':>7} {'ms CPU':>8}")
+    for entidad in ("paciente", "historial", "cita"):
+        datos = json.dumps(generar_pagina(entidad, cantidad), ensure_ascii=False).encode("utf-8")
+        print(f"{entidad:<10} {'ninguno':<9} {len(datos):>9} {1.0:>7.2f} {0.0:>8.3f}")
+        for nombre, comprimir in compresores():
+            tamano, ms = medir(datos, comprimir)
+            print(f"{entidad:<10} {nombre:<9} {tamano:>9} {len(datos) / tamano:>7.2f} {ms:>8.3f}")
+
+if __name__ == "__main__":
+    main()
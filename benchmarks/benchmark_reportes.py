@@ -0,0 +1,47 @@
+"""Benchmark de los motores de reportes: NumPy vectorizado vs. pipeline $group.
+
+Ejecuta cada reporte de reportes.py con ambos motores contra la base de datos
+configurada en .env (sin caché) y reporta el tiempo por ejecución, para elegir
+el motor por reporte con las variables REPORTES_MOTOR_*.
+
+Uso:
+    python benchmarks/benchmark_reportes.py [repeticiones]
+"""
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import database
+import reportes
+
+def medir(calcular, repeticiones: int):
+    """Retorna (mediana, mínimo) en ms"""
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        calcular()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return statistics.median(tiempos), min(tiempos)
+
+def main():
+    repeticiones = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    if not database.get_connection():
+        sys.exit(1)
+
+    print(f"{'reporte':<18} {'motor':<6} {'mediana ms':>11} {'mínimo ms':>10}")
+    for reporte, motores in reportes.MOTORES_REPORTES.items():
+        resultados = {}
+        for motor, calcular in motores.items():
+            calcular()  # calentar conexión y caché de planes
+            resultados[motor] = medir(calcular, repeticiones)
+            print(f"{reporte:<18} {motor:<6} {resultados[motor][0]:>11.1f} {resultados[motor][1]:>10.1f}")
+        mejor = min(resultados, key=lambda motor: resultados[motor][0])
+        print(f"{'':<18} → REPORTES_MOTOR_{reporte.upper()}={mejor}")
+
+    database.close_connection()
+
+if __name__ == "__main__":
+    main()
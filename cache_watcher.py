@@ -0,0 +1,84 @@
+import os
+import threading
+from typing import Optional, Dict, Any
+from pymongo.errors import OperationFailure, PyMongoError
+
+import database
+
+# ===========================================
+# Invalidación de caché entre workers con change streams
+# ===========================================
+CACHE_CHANGE_STREAMS = os.getenv("CACHE_CHANGE_STREAMS", "true").lower() == "true"
+RETRY_SECONDS = float(os.getenv("CACHE_WATCHER_RETRY_SECONDS", "5"))
+
+# Código de MongoDB cuando el resume token ya salió del oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+class CacheInvalidationWatcher:
+    """Hilo en segundo plano que escucha los cambios de las colecciones cacheadas
+    e invalida la caché de lecturas del worker.
+
+    Si el servidor no soporta change streams (por ejemplo, un mongod standalone)
+    el watcher se detiene y la caché queda en modo solo TTL.
+    """
+
+    def __init__(self):
+        self.mode = "stopped"
+        self.resume_token: Optional[Dict[str, Any]] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Inicia el watcher en un hilo daemon"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="cache-invalidation-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Detiene el watcher y espera a que termine el hilo"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=RETRY_SECONDS)
+        self.mode = "stopped"
+
+    def _run(self) -> None:
+        pipeline = [{"$match": {
+            "ns.coll": {"$in": list(database.CACHED_COLLECTIONS)},
+            "operationType": {"$in": ["insert", "update", "replace", "delete"]}
+        }}]
+
+        while not self._stop.is_set():
+            try:
+                db = database.get_database()
+                if db is None:
+                    self._stop.wait(RETRY_SECONDS)
+                    continue
+
+                # Reanudar desde el último evento procesado para no perder cambios
+                with db.watch(pipeline, resume_after=self.resume_token, max_await_time_ms=1000) as stream:
+                    self.mode = "change_streams"
+                    print("👀 Invalidación de caché por change streams activa")
+                    while not self._stop.is_set() and stream.alive:
+                        change = stream.try_next()
+                        if change is not None:
+                            database.invalidate_cache(change["ns"]["coll"], str(change["documentKey"]["_id"]))
+                        self.resume_token = stream.resume_token
+
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    # No se puede reanudar: vaciar la caché y empezar desde ahora
+                    print("⚠️  Resume token expirado, se vacía la caché")
+                    self.resume_token = None
+                    database.clear_cache()
+                    continue
+                print(f"⚠️  Change streams no disponibles, caché en modo solo TTL: {e}")
+                self.mode = "ttl"
+                return
+            except PyMongoError as e:
+                # Error de red: reintentar con el mismo resume token
+                print(f"⚠️  Error en change stream, reintentando: {e}")
+                self._stop.wait(RETRY_SECONDS)
+
+watcher = CacheInvalidationWatcher()
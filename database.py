@@ -1,9 +1,23 @@
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
-from typing import Optional, Dict, List, Any
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError, ExecutionTimeout, DuplicateKeyError
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from bson import Timestamp
+from typing import Optional, Dict, List, Any, Tuple, Callable
+from contextvars import ContextVar
 import os
-from datetime import datetime
+import copy
+import json
+import inspect
+import functools
+import time
+import base64
+import calendar
+import math
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from dotenv import load_dotenv
+from batch_writer import GroupCommitWriter
 
 # Cargar variables de entorno desde .env
 load_dotenv()
@@ -17,6 +31,191 @@ DB_CONFIG = {
     "database": os.getenv("DB_DATABASE")
 }
 
+# Compresión del protocolo de red con MongoDB (en orden de preferencia).
+# zstd requiere el paquete zstandard y snappy el paquete python-snappy.
+DB_COMPRESSORS = os.getenv("DB_COMPRESSORS", "zstd,zlib")
+DB_ZLIB_COMPRESSION_LEVEL = int(os.getenv("DB_ZLIB_COMPRESSION_LEVEL", "6"))
+
+# Perfiles de lectura
+# - "primary": lecturas que siguen a una escritura (leer lo recién escrito)
+# - "list", "export", "stats": lecturas pesadas que pueden ir a secundarios
+READ_MAX_STALENESS = int(os.getenv("DB_READ_MAX_STALENESS", "90"))  # MongoDB exige >= 90 s
+
+READ_PROFILES_CONFIG = {
+    "primary": {
+        "mode": "primary",
+        "read_concern": os.getenv("DB_READ_CONCERN_PRIMARY", "local")
+    },
+    "list": {
+        "mode": os.getenv("DB_READ_MODE_LIST", "secondaryPreferred"),
+        "read_concern": os.getenv("DB_READ_CONCERN_LIST", "local")
+    },
+    "export": {
+        "mode": os.getenv("DB_READ_MODE_EXPORT", "secondaryPreferred"),
+        "read_concern": os.getenv("DB_READ_CONCERN_EXPORT", "local")
+    },
+    "stats": {
+        "mode": os.getenv("DB_READ_MODE_STATS", "secondaryPreferred"),
+        "read_concern": os.getenv("DB_READ_CONCERN_STATS", "local")
+    }
+}
+
+# Modos de read preference soportados (los distintos de primary aceptan maxStalenessSeconds)
+READ_MODES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest
+}
+READ_CONCERN_LEVELS = {"local", "available", "majority", "linearizable", "snapshot"}
+
+# Perfil de lectura de cada ruta ("MÉTODO /ruta" tal como se declara en main.py).
+# Las rutas que no aparecen usan el perfil por defecto de cada operación
+# (listados y lotes "list", lecturas por ID "primary"; en /reportes, "export"
+# para la lectura de columnas completas y "stats" para las agregaciones).
+# Se puede sobrescribir con DB_READ_PROFILE_ROUTES='{"GET /cita": "primary"}'.
+ROUTE_READ_PROFILES = {
+    "GET /paciente": "list",
+    "GET /especialidad": "list",
+    "GET /doctor": "list",
+    "GET /historial": "list",
+    "GET /cita": "list",
+    "POST /paciente/batch-get": "list",
+    "POST /especialidad/batch-get": "list",
+    "POST /doctor/batch-get": "list",
+    "POST /historial/batch-get": "list",
+    "POST /cita/batch-get": "list",
+    "GET /agenda/{id_doctor}/{fecha}": "primary",
+    "POST /admin/agenda/reconstruir": "primary"
+}
+ROUTE_READ_PROFILES.update(json.loads(os.getenv("DB_READ_PROFILE_ROUTES") or "{}"))
+
+# Perfil configurado para la ruta de la petición en curso (lo fija main.ClinicaRoute)
+_route_read_profile: ContextVar[Optional[str]] = ContextVar("route_read_profile", default=None)
+
+def _validate_read_profiles() -> None:
+    """Falla al arrancar si un perfil o una ruta tienen una configuración inválida"""
+    for name, config in READ_PROFILES_CONFIG.items():
+        if config["mode"] not in READ_MODES:
+            raise ValueError(f"Modo de lectura inválido para el perfil {name}: {config['mode']} "
+                             f"(válidos: {', '.join(READ_MODES)})")
+        if config["read_concern"] not in READ_CONCERN_LEVELS:
+            raise ValueError(f"Read concern inválido para el perfil {name}: {config['read_concern']}")
+    for route, profile in ROUTE_READ_PROFILES.items():
+        if profile not in READ_PROFILES_CONFIG:
+            raise ValueError(f"Perfil de lectura desconocido para la ruta {route}: {profile}")
+
+_validate_read_profiles()
+
+# Caché de conteos exactos para consultas filtradas: {clave: (timestamp, total)}
+COUNT_CACHE_TTL = float(os.getenv("DB_COUNT_CACHE_TTL", "30"))
+
+# Caché de lecturas por ID (por worker) para colecciones que cambian poco.
+# Se invalida localmente al escribir y, entre workers, con change streams.
+READ_CACHE_TTL = float(os.getenv("DB_READ_CACHE_TTL", "60"))
+CACHED_COLLECTIONS = {"especialidades", "doctor"}
+_read_cache: Dict[str, Any] = {}
+
+# Máximo de IDs que se resuelven en una sola consulta $in
+BATCH_MAX_IDS = int(os.getenv("DB_BATCH_MAX_IDS", "100"))
+_count_cache: Dict[str, Any] = {}
+
+# Sincronización incremental ("cambios desde")
+# El orden lo da sync_ts, un Timestamp que asigna el servidor al ejecutar la
+# escritura (no el reloj de la app): un Timestamp(0, 0) vacío al insertar y
+# $currentDate al actualizar.
+TOMBSTONES_COLLECTION = "tombstones"
+TOMBSTONE_TTL_DAYS = int(os.getenv("DB_TOMBSTONE_TTL_DAYS", "30"))
+# Margen para no entregar escrituras que aún podrían estar en curso con un timestamp anterior
+SYNC_LAG_SECONDS = float(os.getenv("DB_SYNC_LAG_SECONDS", "1"))
+# Campos internos que no se devuelven en la API
+INTERNAL_FIELDS_PROJECTION = {"sync_ts": 0}
+# Colecciones que usa la API (las que se sincronizan)
+SYNC_COLLECTIONS = ["paciente", "especialidades", "doctor", "historiales", "cita"]
+
+# Claves de idempotencia para los endpoints de creación
+IDEMPOTENCY_COLLECTION = "idempotency_keys"
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+# Tiempo tras el cual una petición "en curso" se considera abandonada (worker caído)
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "30"))
+
+# Inserciones agrupadas (group commit), opt-in por colección:
+# DB_BATCH_INSERT_COLLECTIONS=cita,historiales
+BATCH_INSERT_COLLECTIONS = {
+    name.strip() for name in os.getenv("DB_BATCH_INSERT_COLLECTIONS", "").split(",") if name.strip()
+}
+BATCH_INSERT_MAX_DOCS = int(os.getenv("DB_BATCH_INSERT_MAX_DOCS", "50"))
+BATCH_INSERT_MAX_DELAY_MS = float(os.getenv("DB_BATCH_INSERT_MAX_DELAY_MS", "5"))
+_batch_writers: Dict[str, GroupCommitWriter] = {}
+
+# Agenda materializada: un documento por (doctor, día) con _id "<id_doctor>:<YYYY-MM-DD>"
+AGENDA_COLLECTION = "agenda"
+
+# Profiling compartido entre workers: la captura en curso y las muestras de cada worker
+PROFILING_COLLECTION = "profiling"
+PROFILING_SAMPLES_COLLECTION = "profiling_muestras"
+
+class VersionConflictError(Exception):
+    """La versión esperada no coincide con la versión actual del documento"""
+    pass
+
+class DatabaseUnavailableError(Exception):
+    """La base de datos no respondió (timeout o sin conexión)"""
+    pass
+
+class SyncTokenExpiredError(Exception):
+    """El token de sincronización es anterior a la retención de tombstones: hay que resincronizar todo"""
+    pass
+
+# Errores que indican que la base de datos no está disponible; no deben
+# confundirse con una colección vacía o un documento inexistente
+DB_UNAVAILABLE_ERRORS = (ConnectionFailure, ExecutionTimeout)
+
+def db_operation(error: Optional[str] = None, fallback: Any = None, propagate: Tuple[type, ...] = ()):
+    """Decorador de las operaciones de la capa de datos.
+    
+    Los errores de DB_UNAVAILABLE_ERRORS se relanzan como DatabaseUnavailableError.
+    Si se indica error, cualquier otra excepción (salvo las de propagate) se
+    registra con ese mensaje, formateado con los argumentos de la función, y se
+    retorna fallback (o el resultado de llamarlo con esos argumentos).
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except DatabaseUnavailableError:
+                raise
+            except DB_UNAVAILABLE_ERRORS as e:
+                raise DatabaseUnavailableError(f"MongoDB no disponible: {e}") from e
+            except propagate:
+                raise
+            except Exception as e:
+                if error is None:
+                    raise
+                arguments = signature.bind(*args, **kwargs)
+                arguments.apply_defaults()
+                print(f"❌ {error.format(**arguments.arguments)}: {e}")
+                return fallback(**arguments.arguments) if callable(fallback) else copy.copy(fallback)
+        
+        return wrapper
+    return decorator
+
+# Conexiones que cada worker abre y verifica antes de reportarse listo en /health
+DB_MIN_POOL_SIZE = int(os.getenv("DB_MIN_POOL_SIZE", "2"))
+# Tamaño máximo del pool por worker (lo reparte el control de admisión de middleware.py)
+DB_MAX_POOL_SIZE = int(os.getenv("DB_MAX_POOL_SIZE", "10"))
+
+# Métricas de arranque del worker (en ms desde el fork/inicio del proceso)
+startup_stats: Dict[str, Any] = {
+    "process_start": time.monotonic(),
+    "ready_ms": None,
+    "first_request_ms": None
+}
+
 # Variable global para la conexión
 client = None
 db = None
@@ -50,8 +249,10 @@ def get_connection():
             serverSelectionTimeoutMS=10000,  # 10 segundos
             connectTimeoutMS=10000,
             socketTimeoutMS=10000,
-            maxPoolSize=10,
-            minPoolSize=1
+            maxPoolSize=DB_MAX_POOL_SIZE,
+            minPoolSize=DB_MIN_POOL_SIZE,
+            compressors=DB_COMPRESSORS,
+            zlibCompressionLevel=DB_ZLIB_COMPRESSION_LEVEL
         )
         
         # Obtener la base de datos
@@ -74,6 +275,50 @@ def get_connection():
         print(f"❌ Error inesperado conectando a MongoDB: {e}")
         return False
 
+def reset_connection():
+    """Descarta la conexión heredada del proceso padre (llamar después de un fork)"""
+    global client, db
+    client = None
+    db = None
+    startup_stats.update(process_start=time.monotonic(), ready_ms=None, first_request_ms=None)
+
+def warm_up_pool() -> bool:
+    """Conecta y abre DB_MIN_POOL_SIZE conexiones (al menos una) antes de recibir tráfico"""
+    if db is None and not get_connection():
+        return False
+    try:
+        # Pings concurrentes para forzar la apertura (y el handshake TLS) de varias conexiones;
+        # con minPoolSize=0 se verifica igual una conexión
+        connections = max(DB_MIN_POOL_SIZE, 1)
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            list(executor.map(lambda _: client.admin.command("ping"), range(connections)))
+        startup_stats["ready_ms"] = round((time.monotonic() - startup_stats["process_start"]) * 1000, 1)
+        print(f"🔥 Pool de MongoDB precalentado ({connections} conexiones) en {startup_stats['ready_ms']} ms")
+        return True
+    except Exception as e:
+        print(f"❌ Error precalentando el pool de MongoDB: {e}")
+        return False
+
+def is_ready() -> bool:
+    """Indica si el worker terminó el precalentamiento"""
+    return startup_stats["ready_ms"] is not None
+
+def mark_first_request() -> None:
+    """Registra el tiempo hasta la primera petición exitosa del worker"""
+    if startup_stats["first_request_ms"] is None:
+        startup_stats["first_request_ms"] = round((time.monotonic() - startup_stats["process_start"]) * 1000, 1)
+        print(f"⏱️  Primera petición exitosa a los {startup_stats['first_request_ms']} ms del arranque")
+
+def ping() -> bool:
+    """Verifica la conexión existente sin crear un cliente nuevo"""
+    try:
+        if client is None:
+            return False
+        client.admin.command("ping")
+        return True
+    except Exception:
+        return False
+
 def get_database():
     """Obtiene la instancia de la base de datos"""
     global db
@@ -81,87 +326,546 @@ def get_database():
         get_connection()
     return db
 
-def get_collection(collection_name: str):
-    """Obtiene una colección específica"""
+def invalidate_cache(collection_name: str, document_id: Optional[str] = None) -> None:
+    """Invalida la caché de lecturas y de conteos de una colección (o de un documento)"""
+    if document_id is not None:
+        _read_cache.pop(f"{collection_name}:{document_id}", None)
+    else:
+        for key in [key for key in list(_read_cache) if key.startswith(f"{collection_name}:")]:
+            _read_cache.pop(key, None)
+    
+    for key in [key for key in list(_count_cache) if key.startswith(f"{collection_name}:")]:
+        _count_cache.pop(key, None)
+
+def clear_cache() -> None:
+    """Vacía todas las cachés del worker"""
+    _read_cache.clear()
+    _count_cache.clear()
+
+def get_read_options(profile: str) -> Dict[str, Any]:
+    """Construye las opciones de lectura (read preference y read concern) de un perfil"""
+    config = READ_PROFILES_CONFIG.get(profile, READ_PROFILES_CONFIG["primary"])
+    
+    mode = READ_MODES[config["mode"]]
+    read_preference = mode() if mode is Primary else mode(max_staleness=READ_MAX_STALENESS)
+    
+    return {
+        "read_preference": read_preference,
+        "read_concern": ReadConcern(config["read_concern"])
+    }
+
+def set_route_read_profile(method: str, path: str):
+    """Fija el perfil de lectura configurado para la ruta; retorna el token para restaurarlo"""
+    return _route_read_profile.set(ROUTE_READ_PROFILES.get(f"{method} {path}"))
+
+def reset_route_read_profile(token) -> None:
+    _route_read_profile.reset(token)
+
+def resolve_read_profile(read_profile: Optional[str], default: str) -> str:
+    """Perfil explícito > perfil configurado para la ruta en curso > perfil por defecto de la operación"""
+    return read_profile or _route_read_profile.get() or default
+
+def get_collection(collection_name: str, read_profile: Optional[str] = None):
+    """Obtiene una colección específica, opcionalmente con un perfil de lectura"""
     database = get_database()
-    return database[collection_name]
+    if database is None:
+        raise DatabaseUnavailableError("No hay conexión con MongoDB")
+    collection = database[collection_name]
+    if read_profile:
+        collection = collection.with_options(**get_read_options(read_profile))
+    return collection
+
+def get_batch_writer(collection_name: str) -> GroupCommitWriter:
+    """Obtiene (o crea) el escritor agrupado de una colección"""
+    writer = _batch_writers.get(collection_name)
+    if writer is None:
+        writer = _batch_writers.setdefault(collection_name, GroupCommitWriter(
+            lambda: get_collection(collection_name),
+            max_docs=BATCH_INSERT_MAX_DOCS,
+            max_delay_ms=BATCH_INSERT_MAX_DELAY_MS
+        ))
+    return writer
 
+def get_batch_writer_stats() -> Dict[str, Any]:
+    """Lotes, documentos y errores de los escritores agrupados del worker"""
+    return {name: dict(writer.stats) for name, writer in _batch_writers.items()}
+
+@db_operation(error="Error insertando documento en {collection_name}")
 def insert_document(collection_name: str, document: Dict[str, Any]) -> Optional[str]:
     """Inserta un documento en una colección y retorna el ID"""
-    try:
-        collection = get_collection(collection_name)
-        # Agregar timestamp de creación
-        document["created_at"] = datetime.utcnow()
-        result = collection.insert_one(document)
-        return str(result.inserted_id)
-    except Exception as e:
-        print(f"❌ Error insertando documento en {collection_name}: {e}")
-        return None
+    collection = get_collection(collection_name)
+    # Agregar timestamps de creación/actualización y versión inicial
+    document["created_at"] = datetime.utcnow()
+    document["updated_at"] = document["created_at"]
+    document["version"] = 1
+    # El servidor reemplaza el Timestamp vacío por el suyo al insertar
+    document["sync_ts"] = Timestamp(0, 0)
+    if collection_name in BATCH_INSERT_COLLECTIONS:
+        try:
+            inserted_id = get_batch_writer(collection_name).insert(document)
+        except FutureTimeoutError as e:
+            # El documento se retiró de la cola de escritura agrupada sin insertarse
+            raise DatabaseUnavailableError(f"Tiempo de espera agotado insertando en {collection_name}") from e
+    else:
+        inserted_id = collection.insert_one(document).inserted_id
+    invalidate_cache(collection_name, str(inserted_id))
+    return str(inserted_id)
 
-def find_documents(collection_name: str, filter_dict: Dict[str, Any] = None) -> List[Dict[str, Any]]:
-    """Busca documentos en una colección"""
-    try:
-        collection = get_collection(collection_name)
-        filter_dict = filter_dict or {}
-        documents = list(collection.find(filter_dict))
+@db_operation(error="Error buscando documentos en {collection_name}", fallback=[])
+def find_documents(collection_name: str, filter_dict: Dict[str, Any] = None, read_profile: Optional[str] = None,
+                   skip: int = 0, limit: int = 0) -> List[Dict[str, Any]]:
+    """Busca documentos en una colección (por defecto con el perfil de lectura "list")"""
+    collection = get_collection(collection_name, resolve_read_profile(read_profile, "list"))
+    filter_dict = filter_dict or {}
+    documents = list(collection.find(filter_dict, INTERNAL_FIELDS_PROJECTION).skip(skip).limit(limit))
+    
+    # Convertir ObjectId a string para serialización JSON
+    for doc in documents:
+        if "_id" in doc:
+            doc["_id"] = str(doc["_id"])
+    
+    return documents
+
+@db_operation(error="Error contando documentos en {collection_name}")
+def count_documents(collection_name: str, filter_dict: Dict[str, Any] = None, read_profile: Optional[str] = None) -> Optional[int]:
+    """Cuenta documentos: estimado por metadatos sin filtro, exacto (con caché TTL) con filtro"""
+    collection = get_collection(collection_name, resolve_read_profile(read_profile, "list"))
+    
+    # Sin filtro basta con los metadatos de la colección
+    if not filter_dict:
+        return collection.estimated_document_count()
+    
+    cache_key = f"{collection_name}:{json.dumps(filter_dict, sort_keys=True, default=str)}"
+    cached = _count_cache.get(cache_key)
+    if cached and time.monotonic() - cached[0] < COUNT_CACHE_TTL:
+        return cached[1]
+    
+    total = collection.count_documents(filter_dict)
+    _count_cache[cache_key] = (time.monotonic(), total)
+    return total
+
+@db_operation(error="Error buscando documento por ID en {collection_name}")
+def find_document_by_id(collection_name: str, document_id: str, read_profile: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Busca un documento por ID (por defecto en el primario para leer lo recién escrito)"""
+    from bson import ObjectId
+    
+    cache_key = f"{collection_name}:{document_id}"
+    if collection_name in CACHED_COLLECTIONS:
+        cached = _read_cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < READ_CACHE_TTL:
+            return dict(cached[1])
+    
+    collection = get_collection(collection_name, resolve_read_profile(read_profile, "primary"))
+    document = collection.find_one({"_id": ObjectId(document_id)}, INTERNAL_FIELDS_PROJECTION)
+    
+    if document and "_id" in document:
+        document["_id"] = str(document["_id"])
+    
+    if document and collection_name in CACHED_COLLECTIONS:
+        _read_cache[cache_key] = (time.monotonic(), dict(document))
+    
+    return document
+
+@db_operation()
+def find_document_by_key(collection_name: str, key: str, read_profile: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Busca un documento por un _id que no es ObjectId (por ejemplo, una clave compuesta)"""
+    return get_collection(collection_name, resolve_read_profile(read_profile, "primary")).find_one({"_id": key})
+
+@db_operation(error="Error buscando documentos por IDs en {collection_name}", propagate=(ValueError,),
+              fallback=lambda document_ids, **_: {"documents": [], "missing": list(document_ids)})
+def find_documents_by_ids(collection_name: str, document_ids: List[str], read_profile: Optional[str] = None,
+                          key_field: Optional[str] = None) -> Dict[str, Any]:
+    """Busca varios documentos por ID en una sola consulta $in, conservando el orden pedido.
+    
+    Con key_field los IDs numéricos se buscan además por ese campo (el ID propio
+    de la entidad, ej. doctor.id_doctor), igual que find_documents_by_references.
+    """
+    from bson import ObjectId
+    
+    if len(document_ids) > BATCH_MAX_IDS:
+        raise ValueError(f"Se permiten como máximo {BATCH_MAX_IDS} IDs por consulta")
+    
+    if key_field is not None:
+        found = find_documents_by_references(collection_name, key_field, document_ids, read_profile)
+    else:
+        # IDs únicos y válidos; los inválidos se reportan como faltantes
+        object_ids = list({ObjectId(doc_id) for doc_id in document_ids if ObjectId.is_valid(doc_id)})
         
-        # Convertir ObjectId a string para serialización JSON
-        for doc in documents:
-            if "_id" in doc:
+        collection = get_collection(collection_name, resolve_read_profile(read_profile, "list"))
+        found = {}
+        if object_ids:
+            for doc in collection.find({"_id": {"$in": object_ids}}, INTERNAL_FIELDS_PROJECTION):
                 doc["_id"] = str(doc["_id"])
-        
-        return documents
-    except Exception as e:
-        print(f"❌ Error buscando documentos en {collection_name}: {e}")
-        return []
+                found[doc["_id"]] = doc
+    
+    return {
+        "documents": [found[doc_id] for doc_id in document_ids if doc_id in found],
+        "missing": [doc_id for doc_id in document_ids if doc_id not in found]
+    }
 
-def find_document_by_id(collection_name: str, document_id: str) -> Optional[Dict[str, Any]]:
-    """Busca un documento por ID"""
-    try:
-        from bson import ObjectId
-        collection = get_collection(collection_name)
-        document = collection.find_one({"_id": ObjectId(document_id)})
-        
-        if document and "_id" in document:
-            document["_id"] = str(document["_id"])
+@db_operation()
+def find_documents_by_references(collection_name: str, key_field: str, references: List[Any],
+                                 read_profile: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+    """Resuelve referencias guardadas en otras colecciones (ej. cita.id_paciente) con consultas $in.
+
+    Las referencias numéricas se buscan por key_field (el ID propio de la entidad,
+    ej. paciente.id_paciente) y las que son ObjectId válidos por _id. Retorna
+    {str(referencia): documento}; las que no existen no aparecen.
+    """
+    from bson import ObjectId
+
+    keys = {str(ref) for ref in references if ref is not None}
+    numeric = sorted({int(key) for key in keys if key.isdigit()})
+    object_ids = [ObjectId(key) for key in keys if ObjectId.is_valid(key)]
+
+    collection = get_collection(collection_name, resolve_read_profile(read_profile, "list"))
+    found: Dict[str, Dict[str, Any]] = {}
+    for i in range(0, max(len(numeric), len(object_ids)), BATCH_MAX_IDS):
+        conditions = []
+        if numeric[i:i + BATCH_MAX_IDS]:
+            conditions.append({key_field: {"$in": numeric[i:i + BATCH_MAX_IDS]}})
+        if object_ids[i:i + BATCH_MAX_IDS]:
+            conditions.append({"_id": {"$in": object_ids[i:i + BATCH_MAX_IDS]}})
+        for doc in collection.find({"$or": conditions}, INTERNAL_FIELDS_PROJECTION):
+            doc["_id"] = str(doc["_id"])
+            found[doc["_id"]] = doc
+            if doc.get(key_field) is not None:
+                found[str(doc[key_field])] = doc
+
+    return {key: found[key] for key in keys if key in found}
+
+@db_operation(error="Error actualizando documento en {collection_name}", propagate=(VersionConflictError,))
+def update_document(collection_name: str, document_id: str, update_data: Dict[str, Any],
+                    expected_version: Optional[int] = None) -> Optional[int]:
+    """Actualiza un documento por ID y retorna su nueva versión.
+    
+    Si se indica expected_version la actualización solo se aplica si la versión
+    actual coincide; de lo contrario se lanza VersionConflictError.
+    """
+    from bson import ObjectId
+    collection = get_collection(collection_name)
+    
+    # La versión la mantiene la base de datos, no el cliente
+    update_data.pop("version", None)
+    update_data.pop("_id", None)
+    update_data.pop("sync_ts", None)
+    # Agregar timestamp de actualización
+    update_data["updated_at"] = datetime.utcnow()
+    
+    filter_dict = {"_id": ObjectId(document_id)}
+    if expected_version is not None:
+        # Los documentos anteriores al control de versiones cuentan como versión 0
+        filter_dict["version"] = expected_version if expected_version > 0 else {"$exists": False}
+    
+    result = collection.find_one_and_update(
+        filter_dict,
+        {"$set": update_data, "$inc": {"version": 1}, "$currentDate": {"sync_ts": {"$type": "timestamp"}}},
+        projection={"version": True},
+        return_document=ReturnDocument.AFTER
+    )
+    if result is not None:
+        invalidate_cache(collection_name, document_id)
+        return result["version"]
+    
+    # Distinguir entre documento inexistente y conflicto de versión
+    if expected_version is not None and collection.count_documents({"_id": ObjectId(document_id)}, limit=1):
+        raise VersionConflictError(f"El documento {document_id} fue modificado por otra petición")
+    return None
+
+def supports_transactions() -> bool:
+    """Las transacciones requieren un replica set o un clúster fragmentado"""
+    description = getattr(client, "topology_description", None)
+    return description is not None and description.topology_type_name in ("ReplicaSetWithPrimary", "Sharded")
+
+def _insert_tombstone(collection_name: str, document_id: str, session=None) -> None:
+    """Registra la eliminación para la sincronización incremental"""
+    from bson import ObjectId
+    get_collection(TOMBSTONES_COLLECTION).update_one(
+        {"_id": ObjectId()},
+        {
+            "$setOnInsert": {"collection": collection_name, "document_id": document_id, "updated_at": datetime.utcnow()},
+            "$currentDate": {"sync_ts": {"$type": "timestamp"}}
+        },
+        upsert=True,
+        session=session
+    )
+
+@db_operation(error="Error eliminando documento en {collection_name}", fallback=False)
+def delete_document(collection_name: str, document_id: str) -> bool:
+    """Elimina un documento por ID junto con su tombstone (en una transacción si el servidor la soporta)"""
+    from bson import ObjectId
+    collection = get_collection(collection_name)
+    
+    if supports_transactions():
+        def eliminar(session) -> bool:
+            if collection.delete_one({"_id": ObjectId(document_id)}, session=session).deleted_count == 0:
+                return False
+            _insert_tombstone(collection_name, document_id, session)
+            return True
         
-        return document
-    except Exception as e:
-        print(f"❌ Error buscando documento por ID en {collection_name}: {e}")
-        return None
+        with client.start_session() as session:
+            deleted = session.with_transaction(eliminar)
+    else:
+        deleted = collection.delete_one({"_id": ObjectId(document_id)}).deleted_count > 0
+        if deleted:
+            try:
+                _insert_tombstone(collection_name, document_id)
+            except Exception as e:
+                # El documento ya se eliminó: no reportar la eliminación como fallida
+                print(f"❌ Error registrando tombstone de {collection_name}/{document_id}: {e}")
+    
+    if deleted:
+        invalidate_cache(collection_name, document_id)
+    return deleted
 
-def update_document(collection_name: str, document_id: str, update_data: Dict[str, Any]) -> bool:
-    """Actualiza un documento por ID"""
+@db_operation()
+def reserve_idempotency_key(key: str, request_hash: str) -> bool:
+    """Reserva una clave de idempotencia para el cuerpo con ese hash.
+    
+    Retorna False si ya existe otra petición con esa clave; una reserva
+    abandonada solo la puede tomar una petición con el mismo cuerpo.
+    """
+    collection = get_collection(IDEMPOTENCY_COLLECTION)
+    now = datetime.utcnow()
     try:
-        from bson import ObjectId
-        collection = get_collection(collection_name)
-        
-        # Agregar timestamp de actualización
-        update_data["updated_at"] = datetime.utcnow()
-        
+        # _id es único: dos peticiones concurrentes no pueden reservar la misma clave
+        collection.insert_one({"_id": key, "estado": "en_curso", "hash": request_hash, "created_at": now})
+        return True
+    except DuplicateKeyError:
+        # Tomar la clave si la petición anterior quedó abandonada
         result = collection.update_one(
-            {"_id": ObjectId(document_id)},
-            {"$set": update_data}
+            {"_id": key, "estado": "en_curso", "hash": request_hash,
+             "created_at": {"$lt": now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}},
+            {"$set": {"created_at": now}}
         )
         return result.modified_count > 0
+
+def complete_idempotency_key(key: str, status_code: int, content_type: str, body: bytes) -> None:
+    """Guarda la respuesta original asociada a la clave de idempotencia"""
+    try:
+        get_collection(IDEMPOTENCY_COLLECTION).update_one(
+            {"_id": key},
+            {"$set": {"estado": "completada", "status_code": status_code, "content_type": content_type, "body": body}}
+        )
     except Exception as e:
-        print(f"❌ Error actualizando documento en {collection_name}: {e}")
-        return False
+        print(f"❌ Error guardando respuesta idempotente {key}: {e}")
 
-def delete_document(collection_name: str, document_id: str) -> bool:
-    """Elimina un documento por ID"""
+@db_operation()
+def find_idempotency_key(key: str) -> Optional[Dict[str, Any]]:
+    """Busca el registro de una clave de idempotencia"""
+    return get_collection(IDEMPOTENCY_COLLECTION).find_one({"_id": key})
+
+def release_idempotency_key(key: str) -> None:
+    """Libera una clave reservada cuya petición falló, para permitir reintentos"""
     try:
-        from bson import ObjectId
-        collection = get_collection(collection_name)
-        result = collection.delete_one({"_id": ObjectId(document_id)})
-        return result.deleted_count > 0
+        get_collection(IDEMPOTENCY_COLLECTION).delete_one({"_id": key, "estado": "en_curso"})
     except Exception as e:
-        print(f"❌ Error eliminando documento en {collection_name}: {e}")
-        return False
+        print(f"❌ Error liberando clave de idempotencia {key}: {e}")
 
-def initialize_database():
-    """Inicializa la base de datos MongoDB creando las colecciones y datos de ejemplo"""
-    print("🗄️  Inicializando base de datos MongoDB...")
+@db_operation()
+def save_profiling_capture(capture: Dict[str, Any]) -> None:
+    """Publica una nueva captura de profiling para todos los workers y descarta las muestras anteriores"""
+    get_collection(PROFILING_COLLECTION).replace_one({"_id": "actual"}, dict(capture, _id="actual"), upsert=True)
+    get_collection(PROFILING_SAMPLES_COLLECTION).delete_many({"captura": {"$ne": capture["captura"]}})
+
+@db_operation()
+def find_profiling_capture() -> Optional[Dict[str, Any]]:
+    """Captura de profiling en curso (o la última)"""
+    return get_collection(PROFILING_COLLECTION).find_one({"_id": "actual"})
+
+@db_operation()
+def claim_profiling_request(capture_id: str) -> bool:
+    """Descuenta una petición de la captura; retorna False si ya no quedan o la captura expiró"""
+    return get_collection(PROFILING_COLLECTION).find_one_and_update(
+        {"_id": "actual", "captura": capture_id, "restantes": {"$gt": 0}, "expira_en": {"$gt": datetime.utcnow()}},
+        {"$inc": {"restantes": -1}}
+    ) is not None
+
+@db_operation()
+def save_profiling_samples(capture_id: str, worker: str, stacks: List[List[Any]], samples: int) -> None:
+    """Guarda las pilas muestreadas por un worker ([[pila, cuenta], ...])"""
+    get_collection(PROFILING_SAMPLES_COLLECTION).replace_one(
+        {"_id": f"{capture_id}:{worker}"},
+        {"captura": capture_id, "worker": worker, "pilas": stacks, "muestras": samples, "updated_at": datetime.utcnow()},
+        upsert=True
+    )
+
+@db_operation()
+def find_profiling_samples(capture_id: str) -> List[Dict[str, Any]]:
+    """Muestras guardadas por cada worker para una captura"""
+    return list(get_collection(PROFILING_SAMPLES_COLLECTION).find({"captura": capture_id}))
+
+@db_operation()
+def add_agenda_slot(id_doctor: str, fecha: str, slot: Dict[str, Any]) -> None:
+    """Agrega una cita a la agenda del doctor para el día, manteniendo el orden por hora.
+    
+    Es idempotente: si la agenda ya tiene esa cita no se agrega otra vez.
+    """
+    collection = get_collection(AGENDA_COLLECTION)
+    filter_dict = {"_id": f"{id_doctor}:{fecha}", "citas.id_cita": {"$ne": slot["id_cita"]}}
+    update = {
+        "$push": {"citas": {"$each": [slot], "$sort": {"fecha_hora": 1}}},
+        "$set": {"id_doctor": id_doctor, "fecha": fecha, "updated_at": datetime.utcnow()},
+        "$inc": {"rev": 1}
+    }
+    try:
+        collection.update_one(filter_dict, update, upsert=True)
+    except DuplicateKeyError:
+        # La agenda ya existe: o ya tiene la cita o la creó otra petición al mismo tiempo
+        collection.update_one(filter_dict, update)
+
+@db_operation()
+def remove_agenda_slot(id_cita: str, older_than: Optional[int] = None) -> None:
+    """Quita una cita de la agenda en la que esté (solo sus versiones anteriores a older_than, si se indica)"""
+    slot_filter: Dict[str, Any] = {"id_cita": id_cita}
+    if older_than is not None:
+        # $not también incluye las entradas sin versión
+        slot_filter["version"] = {"$not": {"$gte": older_than}}
+    get_collection(AGENDA_COLLECTION).update_many(
+        {"citas": {"$elemMatch": slot_filter}},
+        {"$pull": {"citas": slot_filter}, "$set": {"updated_at": datetime.utcnow()}, "$inc": {"rev": 1}}
+    )
+
+@db_operation()
+def rename_agenda_paciente(references: List[str], nombre: str) -> None:
+    """Actualiza el nombre desnormalizado de un paciente en todas las agendas"""
+    get_collection(AGENDA_COLLECTION).update_many(
+        {"citas.id_paciente": {"$in": references}},
+        {"$set": {"citas.$[slot].paciente": nombre, "updated_at": datetime.utcnow()}, "$inc": {"rev": 1}},
+        array_filters=[{"slot.id_paciente": {"$in": references}}]
+    )
+
+@db_operation()
+def find_agendas(fecha: str) -> List[Dict[str, Any]]:
+    """Agendas de todos los doctores para un día (leídas del primario)"""
+    return list(get_collection(AGENDA_COLLECTION, "primary").find({"fecha": fecha}))
+
+@db_operation()
+def find_agenda_days(since: Optional[str] = None) -> List[str]:
+    """Días que tienen alguna agenda (desde el día indicado, si se indica)"""
+    return get_collection(AGENDA_COLLECTION, "primary").distinct("fecha", {"fecha": {"$gte": since}} if since else {})
+
+@db_operation()
+def find_field_keys(collection_name: str, field: str, key: Callable[[Any], Any],
+                    filter_dict: Dict[str, Any] = None, read_profile: Optional[str] = None) -> set:
+    """Recorre un solo campo de la colección y retorna el conjunto de key(valor), sin cargar los documentos"""
+    collection = get_collection(collection_name, resolve_read_profile(read_profile, "export"))
+    cursor = collection.find(filter_dict or {}, {field: 1, "_id": 0}, batch_size=BATCH_MAX_IDS)
+    return {key(doc.get(field)) for doc in cursor}
+
+@db_operation()
+def replace_agenda(agenda_id: str, document: Optional[Dict[str, Any]], rev: Optional[int]) -> bool:
+    """Reemplaza una agenda (o la elimina si document es None) solo si no cambió desde que se leyó.
+    
+    rev es la revisión leída (None si la agenda no existía). Cada escritura de la
+    agenda incrementa rev; retorna False si otra petición la modificó entretanto.
+    """
+    collection = get_collection(AGENDA_COLLECTION)
+    if rev is None:
+        if document is None:
+            return True
+        try:
+            collection.insert_one(dict(document, rev=1))
+            return True
+        except DuplicateKeyError:
+            return False
+    
+    # Las agendas anteriores al control de revisiones cuentan como revisión 0
+    filter_dict = {"_id": agenda_id, "rev": rev if rev > 0 else {"$exists": False}}
+    if document is None:
+        return collection.delete_one(filter_dict).deleted_count > 0
+    return collection.replace_one(filter_dict, dict(document, rev=rev + 1)).matched_count > 0
+
+def encode_sync_token(position: Dict[str, List[Any]]) -> str:
+    """Codifica la posición de sincronización (sync_ts, _id) de documentos y eliminaciones"""
+    data: Dict[str, Any] = {
+        key: [[ts.time, ts.inc] if ts else None, str(last_id) if last_id else None]
+        for key, (ts, last_id) in position.items()
+    }
+    data["issued"] = datetime.utcnow().isoformat()
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+def decode_sync_token(token: Optional[str]) -> Dict[str, List[Any]]:
+    """Decodifica un token de sincronización.
+    
+    Lanza ValueError si es inválido y SyncTokenExpiredError si es anterior a la
+    retención de tombstones (las eliminaciones posteriores pueden haberse perdido).
+    """
+    from bson import ObjectId
+    
+    if not token:
+        return {"documents": [None, None], "tombstones": [None, None]}
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token.encode()))
+        issued = datetime.fromisoformat(data["issued"]) if "issued" in data else None
+        position = {
+            key: [Timestamp(*data[key][0]) if data[key][0] else None,
+                  ObjectId(data[key][1]) if data[key][1] else None]
+            for key in ("documents", "tombstones")
+        }
+    except Exception:
+        raise ValueError("Token de sincronización inválido")
+    
+    # Los tokens sin fecha de emisión son del formato anterior (ordenado por updated_at)
+    if issued is None or issued < datetime.utcnow() - timedelta(days=TOMBSTONE_TTL_DAYS):
+        raise SyncTokenExpiredError("Token de sincronización expirado, se requiere una sincronización completa")
+    return position
+
+def _sync_upper_bound() -> Timestamp:
+    """Timestamp del servidor menos SYNC_LAG_SECONDS: no se entregan escrituras más recientes"""
+    hello = get_database().client.admin.command("hello")
+    if "operationTime" in hello:
+        now = hello["operationTime"].time
+    else:
+        now = calendar.timegm(hello["localTime"].utctimetuple())
+    return Timestamp(max(now - math.ceil(SYNC_LAG_SECONDS), 0), 0)
+
+def _sync_filter(position: List[Any], upper: Timestamp) -> Dict[str, Any]:
+    """Filtro de documentos posteriores a la posición (sync_ts, _id) y no más recientes que upper"""
+    ts, last_id = position
+    if ts is None:
+        # Los documentos sin sync_ts (anteriores a la sincronización) van primero
+        sin_marca = {"sync_ts": None}
+        if last_id is not None:
+            sin_marca["_id"] = {"$gt": last_id}
+        return {"$or": [sin_marca, {"sync_ts": {"$lte": upper}}]}
+    return {"$or": [
+        {"sync_ts": {"$gt": ts, "$lte": upper}},
+        {"sync_ts": ts, "_id": {"$gt": last_id}}
+    ]}
+
+@db_operation()
+def find_changes(collection_name: str, token: Optional[str] = None, limit: int = 100) -> Dict[str, Any]:
+    """Retorna los documentos modificados y eliminados desde el token, paginados por (sync_ts, _id)"""
+    position = decode_sync_token(token)
+    upper = _sync_upper_bound()
+    sort = [("sync_ts", 1), ("_id", 1)]
+    
+    collection = get_collection(collection_name, "primary")
+    documents = list(collection.find(_sync_filter(position["documents"], upper)).sort(sort).limit(limit))
+    if documents:
+        position["documents"] = [documents[-1].get("sync_ts"), documents[-1]["_id"]]
+    
+    tombstones_filter = _sync_filter(position["tombstones"], upper)
+    tombstones_filter["collection"] = collection_name
+    tombstones = list(get_collection(TOMBSTONES_COLLECTION, "primary").find(tombstones_filter).sort(sort).limit(limit))
+    if tombstones:
+        position["tombstones"] = [tombstones[-1]["sync_ts"], tombstones[-1]["_id"]]
+    
+    for doc in documents:
+        doc["_id"] = str(doc["_id"])
+        doc.pop("sync_ts", None)
+    
+    return {
+        "documents": documents,
+        "deleted": [tombstone["document_id"] for tombstone in tombstones],
+        "token": encode_sync_token(position),
+        "has_more": len(documents) == limit or len(tombstones) == limit
+    }
+
+def initialize_schema() -> bool:
+    """Crea las colecciones y los índices (idempotente; se ejecuta una vez por despliegue)"""
+    print("🗄️  Inicializando esquema de MongoDB...")
     
     if not get_connection():
         return False
@@ -171,12 +875,54 @@ def initialize_database():
         
         # Crear colecciones si no existen
         collections = ["paciente", "especialidad", "doctor", "historial", "cita"]
+        existing_collections = database.list_collection_names()
         
         for collection_name in collections:
-            if collection_name not in database.list_collection_names():
+            if collection_name not in existing_collections:
                 database.create_collection(collection_name)
                 print(f"✅ Colección '{collection_name}' creada")
         
+        # Crear índices para optimizar consultas
+        database.cita.create_index("fecha_hora")
+        database.cita.create_index("id_paciente")
+        database.cita.create_index("id_doctor")
+        database.historial.create_index("id_paciente")
+        database.historial.create_index("fecha")
+        database.doctor.create_index("id_especialidad")
+        
+        # Índices para la sincronización incremental
+        for collection_name in SYNC_COLLECTIONS:
+            database[collection_name].create_index([("sync_ts", 1), ("_id", 1)])
+        database[TOMBSTONES_COLLECTION].create_index([("collection", 1), ("sync_ts", 1), ("_id", 1)])
+        database[TOMBSTONES_COLLECTION].create_index(
+            "updated_at", name="tombstones_ttl", expireAfterSeconds=TOMBSTONE_TTL_DAYS * 24 * 3600
+        )
+        
+        # Mantenimiento incremental de la agenda materializada
+        database[AGENDA_COLLECTION].create_index("citas.id_cita")
+        database[AGENDA_COLLECTION].create_index("citas.id_paciente")
+        database[AGENDA_COLLECTION].create_index("fecha")
+        
+        # Las claves de idempotencia son únicas por _id y expiran por TTL
+        database[IDEMPOTENCY_COLLECTION].create_index(
+            "created_at", name="idempotency_ttl", expireAfterSeconds=IDEMPOTENCY_TTL_HOURS * 3600
+        )
+        print("✅ Índices creados/verificados")
+        return True
+        
+    except Exception as e:
+        # Sin los índices TTL y únicos el despliegue no debe continuar
+        print(f"❌ Error creando colecciones o índices: {e}")
+        return False
+
+def seed_sample_data() -> bool:
+    """Inserta datos de ejemplo si la base está vacía (solo para desarrollo)"""
+    if get_database() is None:
+        return False
+    
+    try:
+        database = get_database()
+        
         # Verificar si ya existen datos de ejemplo
         especialidad_count = database.especialidad.count_documents({})
         
@@ -211,7 +957,7 @@ def initialize_database():
                 insert_document("especialidad", especialidad)
             
             # Obtener IDs de especialidades para crear doctor
-            especialidad_docs = find_documents("especialidad")
+            especialidad_docs = find_documents("especialidad", read_profile="primary")
             
             # Insertar doctores de ejemplo
             doctor = [
@@ -306,28 +1052,32 @@ def initialize_database():
         else:
             print("ℹ️  Los datos de ejemplo ya existen")
         
-        # Crear índices para optimizar consultas
-        try:
-            database.cita.create_index("fecha_hora")
-            database.cita.create_index("id_paciente")
-            database.cita.create_index("id_doctor")
-            database.historial.create_index("id_paciente")
-            database.historial.create_index("fecha")
-            database.doctor.create_index("id_especialidad")
-            print("✅ Índices creados/verificados")
-        except Exception as e:
-            print(f"⚠️  Advertencia creando índices: {e}")
-        
-        print("🎉 Base de datos MongoDB inicializada correctamente")
         return True
         
     except Exception as e:
-        print(f"❌ Error inicializando base de datos MongoDB: {e}")
+        print(f"❌ Error insertando datos de ejemplo: {e}")
         return False
 
+def initialize_database():
+    """Inicializa la base de datos MongoDB creando las colecciones, índices y datos de ejemplo"""
+    if not initialize_schema() or not seed_sample_data():
+        return False
+    print("🎉 Base de datos MongoDB inicializada correctamente")
+    return True
+
 def close_connection():
     """Cierra la conexión a MongoDB"""
     global client
     if client:
         client.close()
         print("🔌 Conexión a MongoDB cerrada")
+
+if __name__ == "__main__":
+    # Esquema e índices una vez por despliegue (fase release); sale con error si fallan:
+    #   python database.py
+    # En desarrollo, además, datos de ejemplo:
+    #   python database.py --seed
+    import sys
+    ok = initialize_database() if "--seed" in sys.argv[1:] else initialize_schema()
+    close_connection()
+    sys.exit(0 if ok else 1)
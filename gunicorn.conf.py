@@ -0,0 +1,14 @@
+import os
+
+# Configuración de gunicorn (se carga con: gunicorn -c gunicorn.conf.py main:app)
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Importar la app una sola vez en el proceso maestro; los workers la heredan con fork
+preload_app = True
+
+def post_fork(server, worker):
+    """Cada worker crea su propio MongoClient (no es seguro compartirlo entre procesos)"""
+    import database
+    database.reset_connection()
@@ -1,7 +1,12 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response, Body, Header, Request, Query, Depends, Path
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.routing import APIRoute
 import sys
 import os
-from typing import Dict, Any
+from contextlib import asynccontextmanager
+from datetime import datetime
+from starlette.concurrency import run_in_threadpool
+from typing import Dict, Any, Optional, List
 
 # Agregar el directorio models al path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'models'))
@@ -13,14 +18,131 @@ from Historial import Historial
 from Cita import Cita
 
 # Importar servicio de MongoDB
+import database
 import service_mongo as service
+import reportes
+from database import VersionConflictError, DatabaseUnavailableError, SyncTokenExpiredError
+from middleware import (AdmissionControlMiddleware, CompressionMiddleware, IdempotencyMiddleware,
+                        ADMISSION_RETRY_AFTER, obtener_metricas)
+from cache_watcher import watcher, CACHE_CHANGE_STREAMS
+from profiling import TimedRoute, profiler, verificar_admin, ADMIN_TOKEN
+
+class ClinicaRoute(TimedRoute):
+    """Ruta con Server-Timing que además aplica el perfil de lectura configurado para la ruta"""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def handler_con_perfil(request: Request):
+            # El threadpool copia el contexto, así que el perfil llega a la capa de datos
+            token = database.set_route_read_profile(request.method, self.path)
+            try:
+                return await handler(request)
+            finally:
+                database.reset_route_read_profile(token)
+
+        return handler_con_perfil
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Precalienta el pool de MongoDB e inicia/detiene las tareas en segundo plano del worker"""
+    await run_in_threadpool(database.warm_up_pool)
+    if CACHE_CHANGE_STREAMS:
+        watcher.start()
+    # Sin ADMIN_TOKEN no se puede armar una captura: no hace falta consultar MongoDB
+    if ADMIN_TOKEN:
+        profiler.iniciar()
+    yield
+    profiler.detener()
+    watcher.stop()
 
 app = FastAPI(
     title="API Clínica Médica",
     description="API para gestión de pacientes, doctores, especialidades, historiales y citas médicas",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc")
+    redoc_url="/redoc",
+    lifespan=lifespan)
+
+# Medir validate/service/db/serialize en cada ruta (cabecera Server-Timing)
+# y leer con el perfil configurado en database.ROUTE_READ_PROFILES
+app.router.route_class = ClinicaRoute
+
+# Responder los reintentos con Idempotency-Key sin volver a crear el documento
+app.add_middleware(IdempotencyMiddleware)
+# Limitar la concurrencia por clase de ruta frente al pool de MongoDB
+app.add_middleware(AdmissionControlMiddleware)
+# Comprimir respuestas (zstd/gzip); se agrega al final para ser la capa más externa
+app.add_middleware(CompressionMiddleware)
+
+@app.exception_handler(DatabaseUnavailableError)
+async def base_de_datos_no_disponible(request: Request, exc: DatabaseUnavailableError):
+    """Un timeout de MongoDB es un error real, no una lista vacía"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": ADMISSION_RETRY_AFTER}
+    )
+
+def agregar_total(response: Response, total: Optional[int]) -> None:
+    """Agrega el total de documentos en la cabecera X-Total-Count"""
+    if total is not None:
+        response.headers["X-Total-Count"] = str(total)
+
+def obtener_por_ids(resolver, ids: List[str], entidad: str) -> Dict[str, Any]:
+    """Resuelve un lote de IDs y arma la respuesta con los faltantes"""
+    try:
+        resultado = resolver(ids)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "message": f"Lote de {entidad}",
+        "data": resultado["documents"],
+        "faltantes": resultado["missing"]
+    }
+
+def agregar_etag(response: Response, documento: Dict[str, Any]) -> None:
+    """Agrega la versión del documento como ETag (para enviarla luego en If-Match)"""
+    if documento.get("version") is not None:
+        response.headers["ETag"] = f'"{documento["version"]}"'
+
+def actualizar_con_version(actualizar, documento_id: str, datos: Dict[str, Any], response: Response,
+                           if_match: Optional[str], expected_version: Optional[int]) -> Optional[int]:
+    """Aplica una actualización condicional (If-Match / expected_version) y retorna la nueva versión"""
+    if if_match is not None and if_match.strip() == "*":
+        # "*" acepta cualquier versión actual (RFC 9110): sin verificación de versión
+        expected_version = None
+    elif if_match is not None:
+        try:
+            expected_version = int(if_match.replace("W/", "").strip().strip('"'))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Cabecera If-Match inválida")
+    
+    try:
+        version = actualizar(documento_id, datos, expected_version)
+    except VersionConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    if version:
+        response.headers["ETag"] = f'"{version}"'
+    return version
+
+def obtener_cambios(obtener, desde: Optional[str], limite: int, entidad: str) -> Dict[str, Any]:
+    """Arma la respuesta de sincronización incremental de una entidad"""
+    try:
+        cambios = obtener(desde, limite)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except SyncTokenExpiredError as e:
+        # El cliente debe descartar su copia y sincronizar desde cero (sin since)
+        raise HTTPException(status_code=410, detail=str(e))
+    return {
+        "message": f"Cambios de {entidad}",
+        "data": cambios["documents"],
+        "eliminados": cambios["deleted"],
+        "token": cambios["token"],
+        "hay_mas": cambios["has_more"]
+    }
 
 # ===========================================
 # Health Check
@@ -37,31 +159,77 @@ def root():
 
 @app.get("/health")
 def health_check():
-    """Endpoint de health check para Railway"""
-    try:
-        # Verificar conexión a MongoDB
-        from database import get_connection
-        if get_connection():
-            return {
-                "status": "healthy",
-                "message": "API funcionando correctamente",
-                "database": "connected",
-                "timestamp": "2025-09-02T00:00:00Z"
-            }
-        else:
-            return {
-                "status": "unhealthy",
-                "message": "Error de conexión a la base de datos",
-                "database": "disconnected",
-                "timestamp": "2025-09-02T00:00:00Z"
-            }
-    except Exception as e:
+    """Endpoint de health check para Railway (503 hasta que el worker precalentó el pool)"""
+    timestamp = datetime.utcnow().isoformat() + "Z"
+    if not database.is_ready():
+        # Reintentar el precalentamiento si falló durante el arranque
+        database.warm_up_pool()
+    
+    if database.is_ready() and database.ping():
         return {
-            "status": "unhealthy",
-            "message": f"Error en health check: {str(e)}",
-            "database": "error",
-            "timestamp": "2025-09-02T00:00:00Z"
+            "status": "healthy",
+            "message": "API funcionando correctamente",
+            "database": "connected",
+            "timestamp": timestamp
         }
+    return JSONResponse(status_code=503, content={
+        "status": "unhealthy",
+        "message": "Error de conexión a la base de datos",
+        "database": "disconnected",
+        "timestamp": timestamp
+    })
+
+@app.get("/metrics")
+def metricas():
+    """Métricas de control de admisión del worker (cola, en curso, descartes)"""
+    return {
+        "admission": obtener_metricas(),
+        "cache": {
+            "mode": watcher.mode
+        },
+        "startup": {
+            "ready_ms": database.startup_stats["ready_ms"],
+            "first_request_ms": database.startup_stats["first_request_ms"]
+        },
+        "batch_writers": database.get_batch_writer_stats()
+    }
+
+# ===========================================
+# Administración: profiling bajo demanda
+# ===========================================
+@app.post("/admin/profiling", dependencies=[Depends(verificar_admin)])
+def iniciar_profiling(ruta: str, peticiones: int = Query(10, gt=0, le=1000),
+                      intervalo_ms: float = Query(5, ge=1, le=1000)):
+    """Captura un perfil por muestreo de las próximas N peticiones de una ruta (ej. /cita/{cita_id})"""
+    if ruta not in {route.path for route in app.routes if isinstance(route, APIRoute)}:
+        raise HTTPException(status_code=400, detail=f"Ruta desconocida: {ruta}")
+    profiler.armar(ruta, peticiones, intervalo_ms)
+    return {
+        "message": f"Profiling armado para las próximas {peticiones} peticiones de {ruta}",
+        "data": profiler.estado()
+    }
+
+@app.get("/admin/profiling", dependencies=[Depends(verificar_admin)])
+def estado_profiling():
+    return {
+        "message": "Estado del profiling",
+        "data": profiler.estado()
+    }
+
+@app.get("/admin/profiling/folded", dependencies=[Depends(verificar_admin)], response_class=PlainTextResponse)
+def resultado_profiling():
+    """Perfil capturado en formato folded (flamegraph.pl, speedscope), combinado de todos los workers"""
+    folded, workers = profiler.folded()
+    return PlainTextResponse(folded, headers={"X-Profiling-Workers": ",".join(workers)})
+
+@app.post("/admin/agenda/reconstruir", dependencies=[Depends(verificar_admin)])
+def reconstruir_agenda(desde: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$")):
+    """Recalcula la agenda materializada a partir de las citas (desde un día YYYY-MM-DD o completa)"""
+    total = service.reconstruir_agenda(desde)
+    return {
+        "message": f"Agenda reconstruida: {total} agendas",
+        "data": {"agendas": total, "desde": desde}
+    }
 
 # ===========================================
 # CRUD Paciente
@@ -78,39 +246,59 @@ def crear_paciente(paciente: Paciente):
     raise HTTPException(status_code=400, detail="Error al crear el paciente")
 
 @app.get("/paciente")
-def obtener_pacientes():
-    pacientes = service.obtener_pacientes()
+def obtener_pacientes(response: Response, saltar: int = Query(0, ge=0), limite: int = Query(0, ge=0),
+                      incluir_total: bool = True):
+    pacientes = service.obtener_pacientes(saltar, limite)
+    if incluir_total:
+        agregar_total(response, service.contar_pacientes())
     return {
         "message": "Lista de pacientes",
         "data": pacientes
     }
 
+@app.get("/paciente/changes")
+def obtener_cambios_pacientes(since: Optional[str] = None, limite: int = Query(100, gt=0, le=1000)):
+    return obtener_cambios(service.obtener_cambios_pacientes, since, limite, "pacientes")
+
+@app.post("/paciente/batch-get")
+def obtener_pacientes_por_ids(ids: List[str] = Body(..., embed=True)):
+    return obtener_por_ids(service.obtener_pacientes_por_ids, ids, "pacientes")
+
 @app.get("/paciente/{paciente_id}")
-def obtener_paciente(paciente_id: str):
+def obtener_paciente(paciente_id: str, response: Response):
     paciente = service.obtener_paciente(paciente_id)
     if not paciente:
         raise HTTPException(status_code=404, detail="Paciente no encontrado")
+    agregar_etag(response, paciente)
     return {
         "message": f"Paciente {paciente_id}",
         "data": paciente
     }
 
 @app.put("/paciente/{paciente_id}")
-def actualizar_paciente(paciente_id: str, paciente: Paciente):
-    if service.actualizar_paciente(paciente_id, paciente.model_dump()):
+def actualizar_paciente(paciente_id: str, paciente: Paciente, response: Response,
+                        if_match: Optional[str] = Header(None), expected_version: Optional[int] = None):
+    version = actualizar_con_version(service.actualizar_paciente, paciente_id, paciente.model_dump(), response,
+                                     if_match, expected_version)
+    if version:
         return {
             "message": f"Paciente {paciente_id} actualizado exitosamente",
-            "data": paciente.model_dump()
+            "data": paciente.model_dump(),
+            "version": version
         }
     raise HTTPException(status_code=404, detail="Paciente no encontrado")
 
 @app.patch("/paciente/{paciente_id}")
-def actualizar_paciente_parcial(paciente_id: str, paciente_data: Dict[str, Any]):
+def actualizar_paciente_parcial(paciente_id: str, paciente_data: Dict[str, Any], response: Response,
+                                if_match: Optional[str] = Header(None), expected_version: Optional[int] = None):
     """Actualizar solo campos específicos del paciente"""
-    if service.actualizar_paciente(paciente_id, paciente_data):
+    version = actualizar_con_version(service.actualizar_paciente, paciente_id, paciente_data, response,
+                                     if_match, expected_version)
+    if version:
         return {
             "message": f"Paciente {paciente_id} actualizado parcialmente exitosamente",
-            "data": paciente_data
+            "data": paciente_data,
+            "version": version
         }
     raise HTTPException(status_code=404, detail="Paciente no encontrado")
 
@@ -137,39 +325,59 @@ def crear_especialidad(especialidad: Especialidad):
     raise HTTPException(status_code=400, detail="Error al crear la especialidad")
 
 @app.get("/especialidad")
-def obtener_especialidades():
-    especialidades = service.obtener_especialidades()
+def obtener_especialidades(response: Response, saltar: int = Query(0, ge=0), limite: int = Query(0, ge=0),
+                           incluir_total: bool = True):
+    especialidades = service.obtener_especialidades(saltar, limite)
+    if incluir_total:
+        agregar_total(response, service.contar_especialidades())
     return {
         "message": "Lista de especialidades",
         "data": especialidades
     }
 
+@app.get("/especialidad/changes")
+def obtener_cambios_especialidades(since: Optional[str] = None, limite: int = Query(100, gt=0, le=1000)):
+    return obtener_cambios(service.obtener_cambios_especialidades, since, limite, "especialidades")
+
+@app.post("/especialidad/batch-get")
+def obtener_especialidades_por_ids(ids: List[str] = Body(..., embed=True)):
+    return obtener_por_ids(service.obtener_especialidades_por_ids, ids, "especialidades")
+
 @app.get("/especialidad/{especialidad_id}")
-def obtener_especialidad(especialidad_id: str):
+def obtener_especialidad(especialidad_id: str, response: Response):
     especialidad = service.obtener_especialidad(especialidad_id)
     if not especialidad:
         raise HTTPException(status_code=404, detail="Especialidad no encontrada")
+    agregar_etag(response, especialidad)
     return {
         "message": f"Especialidad {especialidad_id}",
         "data": especialidad
     }
 
 @app.put("/especialidad/{especialidad_id}")
-def actualizar_especialidad(especialidad_id: str, especialidad: Especialidad):
-    if service.actualizar_especialidad(especialidad_id, especialidad.model_dump()):
+def actualizar_especialidad(especialidad_id: str, especialidad: Especialidad, response: Response,
+                            if_match: Optional[str] = Header(None), expected_version: Optional[int] = None):
+    version = actualizar_con_version(service.actualizar_especialidad, especialidad_id, especialidad.model_dump(), response,
+                                     if_match, expected_version)
+    if version:
         return {
             "message": f"Especialidad {especialidad_id} actualizada exitosamente",
-            "data": especialidad.model_dump()
+            "data": especialidad.model_dump(),
+            "version": version
         }
     raise HTTPException(status_code=404, detail="Especialidad no encontrada")
 
 @app.patch("/especialidad/{especialidad_id}")
-def actualizar_especialidad_parcial(especialidad_id: str, especialidad_data: Dict[str, Any]):
+def actualizar_especialidad_parcial(especialidad_id: str, especialidad_data: Dict[str, Any], response: Response,
+                                    if_match: Optional[str] = Header(None), expected_version: Optional[int] = None):
     """Actualizar solo campos específicos de la especialidad"""
-    if service.actualizar_especialidad(especialidad_id, especialidad_data):
+    version = actualizar_con_version(service.actualizar_especialidad, especialidad_id, especialidad_data, response,
+                                     if_match, expected_version)
+    if version:
         return {
             "message": f"Especialidad {especialidad_id} actualizada parcialmente exitosamente",
-            "data": especialidad_data
+            "data": especialidad_data,
+            "version": version
         }
     raise HTTPException(status_code=404, detail="Especialidad no encontrada")
 
@@ -196,39 +404,59 @@ def crear_doctor(doctor: Doctor):
     raise HTTPException(status_code=400, detail="Error al crear el doctor")
 
 @app.get("/doctor")
-def obtener_doctores():
-    doctores = service.obtener_doctores()
+def obtener_doctores(response: Response, saltar: int = Query(0, ge=0), limite: int = Query(0, ge=0),
+                     incluir_total: bool = True):
+    doctores = service.obtener_doctores(saltar, limite)
+    if incluir_total:
+        agregar_total(response, service.contar_doctores())
     return {
         "message": "Lista de doctores",
         "data": doctores
     }
 
+@app.get("/doctor/changes")
+def obtener_cambios_doctores(since: Optional[str] = None, limite: int = Query(100, gt=0, le=1000)):
+    return obtener_cambios(service.obtener_cambios_doctores, since, limite, "doctores")
+
+@app.post("/doctor/batch-get")
+def obtener_doctores_por_ids(ids: List[str] = Body(..., embed=True)):
+    return obtener_por_ids(service.obtener_doctores_por_ids, ids, "doctores")
+
 @app.get("/doctor/{doctor_id}")
-def obtener_doctor(doctor_id: str):
+def obtener_doctor(doctor_id: str, response: Response):
     doctor = service.obtener_doctor(doctor_id)
     if not doctor:
         raise HTTPException(status_code=404, detail="Doctor no encontrado")
+    agregar_etag(response, doctor)
     return {
         "message": f"Doctor {doctor_id}",
         "data": doctor
     }
 
 @app.put("/doctor/{doctor_id}")
-def actualizar_doctor(doctor_id: str, doctor: Doctor):
-    if service.actualizar_doctor(doctor_id, doctor.model_dump()):
+def actualizar_doctor(doctor_id: str, doctor: Doctor, response: Response,
+                      if_match: Optional[str] = Header(None), expected_version: Optional[int] = None):
+    version = actualizar_con_version(service.actualizar_doctor, doctor_id, doctor.model_dump(), response,
+                                     if_match, expected_version)
+    if version:
         return {
             "message": f"Doctor {doctor_id} actualizado exitosamente",
-            "data": doctor.model_dump()
+            "data": doctor.model_dump(),
+            "version": version
         }
     raise HTTPException(status_code=404, detail="Doctor no encontrado")
 
 @app.patch("/doctor/{doctor_id}")
-def actualizar_doctor_parcial(doctor_id: str, doctor_data: Dict[str, Any]):
+def actualizar_doctor_parcial(doctor_id: str, doctor_data: Dict[str, Any], response: Response,
+                              if_match: Optional[str] = Header(None), expected_version: Optional[int] = None):
     """Actualizar solo campos específicos del doctor"""
-    if service.actualizar_doctor(doctor_id, doctor_data):
+    version = actualizar_con_version(service.actualizar_doctor, doctor_id, doctor_data, response,
+                                     if_match, expected_version)
+    if version:
         return {
             "message": f"Doctor {doctor_id} actualizado parcialmente exitosamente",
-            "data": doctor_data
+            "data": doctor_data,
+            "version": version
         }
     raise HTTPException(status_code=404, detail="Doctor no encontrado")
 
@@ -255,39 +483,59 @@ def crear_historial(historial: Historial):
     raise HTTPException(status_code=400, detail="Error al crear el historial")
 
 @app.get("/historial")
-def obtener_historiales():
-    historiales = service.obtener_historiales()
+def obtener_historiales(response: Response, saltar: int = Query(0, ge=0), limite: int = Query(0, ge=0),
+                        incluir_total: bool = True):
+    historiales = service.obtener_historiales(saltar, limite)
+    if incluir_total:
+        agregar_total(response, service.contar_historiales())
     return {
         "message": "Lista de historiales",
         "data": historiales
     }
 
+@app.get("/historial/changes")
+def obtener_cambios_historiales(since: Optional[str] = None, limite: int = Query(100, gt=0, le=1000)):
+    return obtener_cambios(service.obtener_cambios_historiales, since, limite, "historiales")
+
+@app.post("/historial/batch-get")
+def obtener_historiales_por_ids(ids: List[str] = Body(..., embed=True)):
+    return obtener_por_ids(service.obtener_historiales_por_ids, ids, "historiales")
+
 @app.get("/historial/{historial_id}")
-def obtener_historial(historial_id: str):
+def obtener_historial(historial_id: str, response: Response):
     historial = service.obtener_historial(historial_id)
     if not historial:
         raise HTTPException(status_code=404, detail="Historial no encontrado")
+    agregar_etag(response, historial)
     return {
         "message": f"Historial {historial_id}",
         "data": historial
     }
 
 @app.put("/historial/{historial_id}")
-def actualizar_historial(historial_id: str, historial: Historial):
-    if service.actualizar_historial(historial_id, historial.model_dump()):
+def actualizar_historial(historial_id: str, historial: Historial, response: Response,
+                         if_match: Optional[str] = Header(None), expected_version: Optional[int] = None):
+    version = actualizar_con_version(service.actualizar_historial, historial_id, historial.model_dump(), response,
+                                     if_match, expected_version)
+    if version:
         return {
             "message": f"Historial {historial_id} actualizado exitosamente",
-            "data": historial.model_dump()
+            "data": historial.model_dump(),
+            "version": version
         }
     raise HTTPException(status_code=404, detail="Historial no encontrado")
 
 @app.patch("/historial/{historial_id}")
-def actualizar_historial_parcial(historial_id: str, historial_data: Dict[str, Any]):
+def actualizar_historial_parcial(historial_id: str, historial_data: Dict[str, Any], response: Response,
+                                 if_match: Optional[str] = Header(None), expected_version: Optional[int] = None):
     """Actualizar solo campos específicos del historial"""
-    if service.actualizar_historial(historial_id, historial_data):
+    version = actualizar_con_version(service.actualizar_historial, historial_id, historial_data, response,
+                                     if_match, expected_version)
+    if version:
         return {
             "message": f"Historial {historial_id} actualizado parcialmente exitosamente",
-            "data": historial_data
+            "data": historial_data,
+            "version": version
         }
     raise HTTPException(status_code=404, detail="Historial no encontrado")
 
@@ -314,39 +562,68 @@ def crear_cita(cita: Cita):
     raise HTTPException(status_code=400, detail="Error al crear la cita")
 
 @app.get("/cita")
-def obtener_citas():
-    citas = service.obtener_citas()
-    return {
+def obtener_citas(response: Response, saltar: int = Query(0, ge=0), limite: int = Query(0, ge=0),
+                  incluir_total: bool = True, expand: Optional[str] = None):
+    campos = [campo.strip() for campo in expand.split(",")] if expand else []
+    invalidos = [campo for campo in campos if campo not in service.CAMPOS_EXPANDIBLES]
+    if invalidos:
+        raise HTTPException(status_code=400, detail=f"No se puede expandir: {', '.join(invalidos)}")
+    
+    citas = service.obtener_citas(saltar, limite)
+    if incluir_total:
+        agregar_total(response, service.contar_citas())
+    respuesta = {
         "message": "Lista de citas",
         "data": citas
     }
+    if campos:
+        # Referencias que no existen: el campo expandido queda en null
+        respuesta["faltantes"] = service.expandir_citas(citas, campos)
+    return respuesta
+
+@app.get("/cita/changes")
+def obtener_cambios_citas(since: Optional[str] = None, limite: int = Query(100, gt=0, le=1000)):
+    return obtener_cambios(service.obtener_cambios_citas, since, limite, "citas")
+
+@app.post("/cita/batch-get")
+def obtener_citas_por_ids(ids: List[str] = Body(..., embed=True)):
+    return obtener_por_ids(service.obtener_citas_por_ids, ids, "citas")
 
 @app.get("/cita/{cita_id}")
-def obtener_cita(cita_id: str):
+def obtener_cita(cita_id: str, response: Response):
     cita = service.obtener_cita(cita_id)
     if not cita:
         raise HTTPException(status_code=404, detail="Cita no encontrada")
+    agregar_etag(response, cita)
     return {
         "message": f"Cita {cita_id}",
         "data": cita
     }
 
 @app.put("/cita/{cita_id}")
-def actualizar_cita(cita_id: str, cita: Cita):
-    if service.actualizar_cita(cita_id, cita.model_dump()):
+def actualizar_cita(cita_id: str, cita: Cita, response: Response,
+                    if_match: Optional[str] = Header(None), expected_version: Optional[int] = None):
+    version = actualizar_con_version(service.actualizar_cita, cita_id, cita.model_dump(), response,
+                                     if_match, expected_version)
+    if version:
         return {
             "message": f"Cita {cita_id} actualizada exitosamente",
-            "data": cita.model_dump()
+            "data": cita.model_dump(),
+            "version": version
         }
     raise HTTPException(status_code=404, detail="Cita no encontrada")
 
 @app.patch("/cita/{cita_id}")
-def actualizar_cita_parcial(cita_id: str, cita_data: Dict[str, Any]):
+def actualizar_cita_parcial(cita_id: str, cita_data: Dict[str, Any], response: Response,
+                            if_match: Optional[str] = Header(None), expected_version: Optional[int] = None):
     """Actualizar solo campos específicos de la cita"""
-    if service.actualizar_cita(cita_id, cita_data):
+    version = actualizar_con_version(service.actualizar_cita, cita_id, cita_data, response,
+                                     if_match, expected_version)
+    if version:
         return {
             "message": f"Cita {cita_id} actualizada parcialmente exitosamente",
-            "data": cita_data
+            "data": cita_data,
+            "version": version
         }
     raise HTTPException(status_code=404, detail="Cita no encontrada")
 
@@ -357,3 +634,41 @@ def eliminar_cita(cita_id: str):
             "message": f"Cita {cita_id} eliminada exitosamente"
         }
     raise HTTPException(status_code=404, detail="Cita no encontrada")
+
+# ===========================================
+# Agenda por doctor y día
+# ===========================================
+@app.get("/agenda/{id_doctor}/{fecha}")
+def obtener_agenda(id_doctor: str, fecha: str = Path(..., pattern=r"^\d{4}-\d{2}-\d{2}$")):
+    """Agenda de un doctor para un día (YYYY-MM-DD) con los nombres de los pacientes"""
+    return {
+        "message": f"Agenda del doctor {id_doctor} para {fecha}",
+        "data": service.obtener_agenda(id_doctor, fecha)
+    }
+
+# ===========================================
+# Reportes
+# ===========================================
+@app.get("/reportes/edades")
+def reporte_edades(motor: Optional[str] = Query(None, pattern="^(numpy|mongo)$")):
+    """Distribución de edades de los pacientes"""
+    return {
+        "message": "Distribución de edades de pacientes",
+        "data": reportes.obtener_reporte("edades", motor)
+    }
+
+@app.get("/reportes/citas-por-doctor")
+def reporte_citas_por_doctor(motor: Optional[str] = Query(None, pattern="^(numpy|mongo)$")):
+    """Citas, asistencia y no-shows por doctor y por especialidad"""
+    return {
+        "message": "Asistencia por doctor y especialidad",
+        "data": reportes.obtener_reporte("citas_por_doctor", motor)
+    }
+
+@app.get("/reportes/horas-pico")
+def reporte_horas_pico(motor: Optional[str] = Query(None, pattern="^(numpy|mongo)$")):
+    """Horas y días de la semana con más citas"""
+    return {
+        "message": "Horas pico de citas",
+        "data": reportes.obtener_reporte("horas_pico", motor)
+    }
@@ -0,0 +1,407 @@
+import asyncio
+import hashlib
+import os
+import zlib
+from typing import Dict, Any, Optional, List
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse, Response
+
+import database
+from cache_watcher import CACHE_CHANGE_STREAMS
+
+try:
+    import zstandard
+except ImportError:  # zstd es opcional; sin la librería se usa solo gzip
+    zstandard = None
+
+# ===========================================
+# Control de admisión y descarte de carga
+# ===========================================
+# Cada clase de ruta tiene un presupuesto de peticiones concurrentes y una cola
+# de espera acotada. Los presupuestos deben sumar como máximo el tamaño del pool
+# de MongoDB (maxPoolSize) menos las conexiones reservadas para tareas de fondo,
+# para que las peticiones no esperen dentro del driver.
+ADMISSION_CONFIG = {
+    "reads": {
+        "limit": int(os.getenv("ADMISSION_READS_LIMIT", "4")),
+        "queue": int(os.getenv("ADMISSION_READS_QUEUE", "20"))
+    },
+    "writes": {
+        "limit": int(os.getenv("ADMISSION_WRITES_LIMIT", "4")),
+        "queue": int(os.getenv("ADMISSION_WRITES_QUEUE", "20"))
+    },
+    "exports": {
+        "limit": int(os.getenv("ADMISSION_EXPORTS_LIMIT", "1")),
+        "queue": int(os.getenv("ADMISSION_EXPORTS_QUEUE", "2"))
+    }
+}
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2"))
+
+# El watcher de change streams mantiene una conexión ocupada con getMore de espera
+CONEXIONES_RESERVADAS = 1 if CACHE_CHANGE_STREAMS else 0
+
+def validar_presupuestos() -> None:
+    """Avisa al arrancar si los presupuestos de admisión exceden las conexiones disponibles"""
+    total = sum(budget["limit"] for budget in ADMISSION_CONFIG.values())
+    disponibles = database.DB_MAX_POOL_SIZE - CONEXIONES_RESERVADAS
+    if total > disponibles:
+        print(f"⚠️  Los presupuestos de admisión suman {total} y el pool solo tiene {disponibles} "
+              f"conexiones libres (DB_MAX_POOL_SIZE={database.DB_MAX_POOL_SIZE}, reservadas={CONEXIONES_RESERVADAS})")
+
+validar_presupuestos()
+ADMISSION_RETRY_AFTER = os.getenv("ADMISSION_RETRY_AFTER", "1")
+
+# Rutas que nunca se limitan (health check, métricas y documentación)
+RUTAS_SIN_LIMITE = {"/", "/health", "/metrics", "/docs", "/redoc", "/openapi.json"}
+
+# Métricas por clase de ruta (por worker)
+admission_metrics: Dict[str, Dict[str, int]] = {
+    route_class: {"in_flight": 0, "queued": 0, "admitted": 0, "shed": 0}
+    for route_class in ADMISSION_CONFIG
+}
+
+def clasificar_ruta(method: str, path: str) -> Optional[str]:
+    """Clasifica una petición en reads, writes o exports (None si no se limita)"""
+    if path in RUTAS_SIN_LIMITE:
+        return None
+    if path.startswith("/reportes") or path.endswith("/export"):
+        return "exports"
+    if method in ("GET", "HEAD") or path.endswith("/batch-get"):
+        return "reads"
+    return "writes"
+
+class AdmissionControlMiddleware:
+    """Middleware ASGI que limita la concurrencia por clase de ruta y descarta
+    peticiones con 503 + Retry-After cuando la cola de espera está llena"""
+
+    def __init__(self, app, config: Optional[Dict[str, Dict[str, int]]] = None,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT):
+        self.app = app
+        self.config = config or ADMISSION_CONFIG
+        self.queue_timeout = queue_timeout
+        self.semaphores = {
+            route_class: asyncio.Semaphore(budget["limit"])
+            for route_class, budget in self.config.items()
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route_class = clasificar_ruta(scope["method"], scope["path"])
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        semaphore = self.semaphores[route_class]
+        metrics = admission_metrics[route_class]
+
+        # Cola llena: descartar de inmediato en lugar de acumular latencia
+        if semaphore.locked() and metrics["queued"] >= self.config[route_class]["queue"]:
+            await self._shed(scope, receive, send, metrics)
+            return
+
+        metrics["queued"] += 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            await self._shed(scope, receive, send, metrics)
+            return
+        finally:
+            metrics["queued"] -= 1
+
+        metrics["admitted"] += 1
+        metrics["in_flight"] += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            metrics["in_flight"] -= 1
+            semaphore.release()
+
+    async def _shed(self, scope, receive, send, metrics: Dict[str, int]) -> None:
+        """Responde 503 indicando al cliente cuándo reintentar"""
+        metrics["shed"] += 1
+        response = JSONResponse(
+            status_code=503,
+            content={"detail": "Servidor saturado, intente de nuevo más tarde"},
+            headers={"Retry-After": ADMISSION_RETRY_AFTER}
+        )
+        await response(scope, receive, send)
+
+def obtener_metricas() -> Dict[str, Any]:
+    """Retorna la profundidad de cola, peticiones en curso y descartes por clase de ruta"""
+    return {
+        route_class: dict(metrics, limit=ADMISSION_CONFIG[route_class]["limit"],
+                          max_queue=ADMISSION_CONFIG[route_class]["queue"])
+        for route_class, metrics in admission_metrics.items()
+    }
+
+# ===========================================
+# Idempotencia de los endpoints de creación
+# ===========================================
+RUTAS_CREACION = {"/paciente", "/especialidad", "/doctor", "/historial", "/cita"}
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "5"))
+IDEMPOTENCY_POLL_SECONDS = 0.05
+
+async def _leer_cuerpo(receive) -> bytes:
+    """Lee el cuerpo completo de la petición"""
+    partes = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        partes.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(partes)
+
+class IdempotencyMiddleware:
+    """Middleware ASGI para la cabecera Idempotency-Key en los POST de creación.
+
+    La primera petición con una clave reserva la clave junto con el hash de su
+    cuerpo, se procesa normalmente y, si fue exitosa (2xx), su respuesta queda
+    guardada. Los reintentos con la misma clave y el mismo cuerpo reciben la
+    respuesta guardada sin validar ni insertar de nuevo; si la original sigue en
+    curso, esperan a que termine. Reusar la clave con otro cuerpo responde 422.
+    """
+
+    def __init__(self, app, rutas=None):
+        self.app = app
+        self.rutas = rutas or RUTAS_CREACION
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.rutas:
+            await self.app(scope, receive, send)
+            return
+
+        key = Headers(scope=scope).get("idempotency-key")
+        if not key:
+            await self.app(scope, receive, send)
+            return
+        if len(key) > 255:
+            await JSONResponse(status_code=400, content={"detail": "Idempotency-Key demasiado larga"})(scope, receive, send)
+            return
+
+        # El cuerpo se lee completo para asociarlo a la clave y luego se entrega a la app
+        body = await _leer_cuerpo(receive)
+        request_hash = hashlib.sha256(body).hexdigest()
+        entregado = False
+
+        async def receive_body():
+            nonlocal entregado
+            if not entregado:
+                entregado = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        store_key = f"{scope['path']}:{key}"
+        try:
+            reservada = await run_in_threadpool(database.reserve_idempotency_key, store_key, request_hash)
+            if not reservada:
+                await self._repetir(store_key, request_hash, scope, receive, send)
+                return
+        except database.DatabaseUnavailableError as e:
+            await JSONResponse(status_code=503, content={"detail": str(e)},
+                               headers={"Retry-After": ADMISSION_RETRY_AFTER})(scope, receive, send)
+            return
+
+        respuesta = {"status": 500, "content_type": "application/json", "body": []}
+
+        async def send_and_capture(message):
+            if message["type"] == "http.response.start":
+                respuesta["status"] = message["status"]
+                respuesta["content_type"] = Headers(raw=message["headers"]).get("content-type", "application/json")
+            elif message["type"] == "http.response.body":
+                respuesta["body"].append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_body, send_and_capture)
+        except Exception:
+            await run_in_threadpool(database.release_idempotency_key, store_key)
+            raise
+
+        # Solo se guardan las respuestas exitosas: tras un error de validación o del
+        # servidor el cliente puede corregir la petición o reintentar con la misma clave
+        if 200 <= respuesta["status"] < 300:
+            await run_in_threadpool(database.complete_idempotency_key, store_key, respuesta["status"],
+                                    respuesta["content_type"], b"".join(respuesta["body"]))
+        else:
+            await run_in_threadpool(database.release_idempotency_key, store_key)
+
+    async def _repetir(self, store_key: str, request_hash: str, scope, receive, send) -> None:
+        """Responde con la respuesta guardada, esperando si la original sigue en curso"""
+        esperado = 0.0
+        while True:
+            registro = await run_in_threadpool(database.find_idempotency_key, store_key)
+            if registro and registro.get("hash") != request_hash:
+                await JSONResponse(
+                    status_code=422,
+                    content={"detail": "La Idempotency-Key ya se usó con otro cuerpo de petición"}
+                )(scope, receive, send)
+                return
+            if registro and registro.get("estado") == "completada":
+                response = Response(
+                    content=registro["body"],
+                    status_code=registro["status_code"],
+                    media_type=registro["content_type"],
+                    headers={"Idempotent-Replayed": "true"}
+                )
+                await response(scope, receive, send)
+                return
+            if esperado >= IDEMPOTENCY_WAIT_SECONDS:
+                break
+            await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+            esperado += IDEMPOTENCY_POLL_SECONDS
+
+        await JSONResponse(
+            status_code=409,
+            content={"detail": "Hay una petición en curso con la misma Idempotency-Key"},
+            headers={"Retry-After": ADMISSION_RETRY_AFTER}
+        )(scope, receive, send)
+
+# ===========================================
+# Compresión de respuestas (zstd / gzip)
+# ===========================================
+COMPRESSION_MINIMUM_SIZE = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+
+class _GzipCompressor:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31: formato gzip
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush_chunk(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+class _ZstdCompressor:
+    def __init__(self, level: int):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush_chunk(self) -> bytes:
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+def negociar_codificacion(accept_encoding: str) -> Optional[str]:
+    """Elige la codificación preferida por el servidor entre las que acepta el cliente"""
+    aceptadas: List[str] = []
+    for parte in accept_encoding.lower().split(","):
+        nombre, _, parametros = parte.strip().partition(";")
+        if parametros.replace(" ", "") in ("q=0", "q=0.0"):
+            continue
+        aceptadas.append(nombre.strip())
+    
+    if zstandard is not None and "zstd" in aceptadas:
+        return "zstd"
+    if "gzip" in aceptadas:
+        return "gzip"
+    return None
+
+class CompressionMiddleware:
+    """Middleware ASGI que comprime las respuestas con zstd o gzip según
+    Accept-Encoding. Las respuestas completas menores a minimum_size se envían
+    sin comprimir; las respuestas en streaming se comprimen por bloques."""
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negociar_codificacion(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        responder = _CompressionResponder(self.app, encoding, self.minimum_size)
+        await responder(scope, receive, send)
+
+class _CompressionResponder:
+    def __init__(self, app, encoding: str, minimum_size: int):
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.send = None
+        self.initial_message: Dict[str, Any] = {}
+        self.started = False
+        self.passthrough = False
+        self.compressor = None
+
+    async def __call__(self, scope, receive, send):
+        self.send = send
+        await self.app(scope, receive, self.send_with_compression)
+
+    def _new_compressor(self):
+        if self.encoding == "zstd":
+            return _ZstdCompressor(COMPRESSION_ZSTD_LEVEL)
+        return _GzipCompressor(COMPRESSION_GZIP_LEVEL)
+
+    async def send_with_compression(self, message):
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            # Retener los encabezados hasta conocer el primer bloque del cuerpo
+            self.initial_message = message
+            self.passthrough = "content-encoding" in Headers(raw=message["headers"])
+            return
+
+        if message_type != "http.response.body" or self.passthrough:
+            if not self.started and self.initial_message:
+                self.started = True
+                await self.send(self.initial_message)
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if not self.started:
+            self.started = True
+            headers = MutableHeaders(raw=self.initial_message["headers"])
+
+            if not more_body:
+                # Respuesta completa: comprimir solo si supera el umbral
+                if len(body) < self.minimum_size:
+                    await self.send(self.initial_message)
+                    await self.send(message)
+                    return
+                compressor = self._new_compressor()
+                body = compressor.compress(body) + compressor.finish()
+                headers["Content-Encoding"] = self.encoding
+                headers["Content-Length"] = str(len(body))
+                headers.add_vary_header("Accept-Encoding")
+                await self.send(self.initial_message)
+                await self.send({"type": "http.response.body", "body": body})
+                return
+
+            # Respuesta en streaming: comprimir cada bloque a medida que llega
+            self.compressor = self._new_compressor()
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            del headers["Content-Length"]
+            await self.send(self.initial_message)
+
+        if self.compressor is None:
+            await self.send(message)
+            return
+
+        if more_body:
+            chunk = self.compressor.compress(body) + self.compressor.flush_chunk()
+        else:
+            chunk = self.compressor.compress(body) + self.compressor.finish()
+        await self.send({"type": "http.response.body", "body": chunk, "more_body": more_body})
@@ -0,0 +1,337 @@
+import os
+import sys
+import time
+import socket
+import secrets
+import asyncio
+import functools
+import threading
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+from fastapi import Header, HTTPException, Request
+from fastapi.routing import APIRoute
+from pymongo import monitoring
+from starlette.concurrency import run_in_threadpool
+
+import database
+
+# ===========================================
+# Tiempos por etapa (Server-Timing)
+# ===========================================
+# Etapas: validate (parseo y validación Pydantic), service (endpoint y servicio
+# sin contar MongoDB), db (comandos a MongoDB) y serialize (codificación JSON).
+_timings: ContextVar[Optional[Dict[str, Any]]] = ContextVar("timings", default=None)
+
+class DbTimingListener(monitoring.CommandListener):
+    """Acumula la duración de los comandos de MongoDB de la petición en curso"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._acumular(event.duration_micros)
+
+    def failed(self, event):
+        self._acumular(event.duration_micros)
+
+    def _acumular(self, duration_micros: int) -> None:
+        timings = _timings.get()
+        if timings is not None:
+            timings["db"] += duration_micros / 1000
+
+# Se registra globalmente: aplica a los MongoClient creados después de importar este módulo
+monitoring.register(DbTimingListener())
+
+def _formato_server_timing(timings: Dict[str, Any]) -> str:
+    return ", ".join(
+        f"{etapa};dur={timings[etapa]:.2f}"
+        for etapa in ("validate", "service", "db", "serialize", "total")
+    )
+
+def _cronometrar_endpoint(endpoint):
+    """Envuelve el endpoint para medir su duración y registrar el hilo si se perfila"""
+
+    def iniciar():
+        timings = _timings.get()
+        if timings is not None:
+            timings["endpoint_inicio"] = time.perf_counter()
+            timings["db_inicio"] = timings["db"]
+            if timings["perfilar"]:
+                profiler.registrar(threading.get_ident())
+        return timings
+
+    def terminar(timings):
+        if timings is not None:
+            timings["endpoint_fin"] = time.perf_counter()
+            timings["service"] = (timings["endpoint_fin"] - timings["endpoint_inicio"]) * 1000 - (timings["db"] - timings["db_inicio"])
+            if timings["perfilar"]:
+                profiler.liberar(threading.get_ident())
+
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            timings = iniciar()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                terminar(timings)
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            timings = iniciar()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                terminar(timings)
+    return wrapper
+
+class TimedRoute(APIRoute):
+    """Ruta que mide las etapas de cada petición y las agrega como cabecera Server-Timing"""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, _cronometrar_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request: Request):
+            timings = {"validate": 0.0, "service": 0.0, "db": 0.0, "serialize": 0.0, "total": 0.0,
+                       "perfilar": await profiler.reclamar(self.path)}
+            token = _timings.set(timings)
+            inicio = time.perf_counter()
+            try:
+                response = await handler(request)
+            finally:
+                fin = time.perf_counter()
+                _timings.reset(token)
+                if timings["perfilar"]:
+                    profiler.terminar_peticion()
+
+            timings["total"] = (fin - inicio) * 1000
+            if "endpoint_inicio" in timings:
+                timings["validate"] = (timings["endpoint_inicio"] - inicio) * 1000
+                timings["serialize"] = (fin - timings["endpoint_fin"]) * 1000
+            response.headers["Server-Timing"] = _formato_server_timing(timings)
+            if response.status_code < 400 and self.path not in ("/health", "/metrics"):
+                database.mark_first_request()
+            return response
+
+        return timed_handler
+
+# ===========================================
+# Profiler por muestreo bajo demanda
+# ===========================================
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Cada cuánto revisa cada worker si hay una captura nueva armada por otro worker
+PROFILING_POLL_SECONDS = float(os.getenv("PROFILING_POLL_SECONDS", "2"))
+# Duración máxima de una captura: si la ruta no recibe las peticiones pedidas, se desarma igual
+PROFILING_MAX_SECONDS = float(os.getenv("PROFILING_MAX_SECONDS", "300"))
+
+def worker_id() -> str:
+    """Identificador del worker (host y pid; el pid cambia después del fork)"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class SamplingProfiler:
+    """Muestrea periódicamente las pilas de los hilos del threadpool que ejecutan
+    los endpoints de las próximas N peticiones de una ruta y las acumula en formato
+    "folded" (compatible con flamegraph.pl y speedscope). La validación y la
+    serialización ocurren en el event loop y se ven en Server-Timing.
+
+    La captura se comparte entre los workers de gunicorn a través de MongoDB: el
+    contador de peticiones restantes es global, cada worker adopta la captura al
+    verla y guarda sus muestras al terminar, y el resultado combina las de todos.
+    Cada captura expira a los PROFILING_MAX_SECONDS aunque queden peticiones.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._poller: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.captura: Optional[str] = None
+        self.ruta: Optional[str] = None
+        self.armado = False
+        self.expira_en: Optional[datetime] = None
+        self.en_curso = 0
+        self.intervalo = 0.005
+        self.hilos: Counter = Counter()
+        self.pilas: Counter = Counter()
+        self.muestras = 0
+
+    def iniciar(self) -> None:
+        """Inicia el hilo que adopta las capturas armadas desde cualquier worker"""
+        if self._poller is not None and self._poller.is_alive():
+            return
+        self._stop.clear()
+        self._poller = threading.Thread(target=self._vigilar, name="profiling-poller", daemon=True)
+        self._poller.start()
+
+    def detener(self) -> None:
+        self._stop.set()
+        if self._poller is not None:
+            self._poller.join(timeout=PROFILING_POLL_SECONDS)
+
+    def armar(self, ruta: str, peticiones: int, intervalo_ms: float) -> None:
+        """Prepara la captura de las próximas `peticiones` peticiones de `ruta` en todos los workers"""
+        ahora = datetime.utcnow()
+        captura = {
+            "captura": secrets.token_hex(8),
+            "ruta": ruta,
+            "peticiones": peticiones,
+            "restantes": peticiones,
+            "intervalo_ms": intervalo_ms,
+            "armado_en": ahora,
+            "expira_en": ahora + timedelta(seconds=PROFILING_MAX_SECONDS)
+        }
+        database.save_profiling_capture(captura)
+        self._adoptar(captura)
+
+    def _adoptar(self, captura: Dict[str, Any]) -> None:
+        """Sincroniza el estado local con la captura publicada"""
+        with self._lock:
+            if captura["captura"] != self.captura:
+                self.captura = captura["captura"]
+                self.ruta = captura["ruta"]
+                self.intervalo = captura["intervalo_ms"] / 1000
+                self.pilas = Counter()
+                self.muestras = 0
+            # Las capturas sin expira_en son de una versión anterior: se consideran vencidas
+            self.expira_en = captura.get("expira_en")
+            self.armado = captura["restantes"] > 0 and not self._expirada()
+            if self.armado and not self.activo:
+                self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+                self._thread.start()
+
+    def _vigilar(self) -> None:
+        while not self._stop.is_set():
+            try:
+                captura = database.find_profiling_capture()
+                if captura is not None:
+                    self._adoptar(captura)
+            except Exception as e:
+                print(f"⚠️  Error consultando la captura de profiling: {e}")
+            self._stop.wait(PROFILING_POLL_SECONDS)
+
+    async def reclamar(self, ruta: str) -> bool:
+        """Indica si esta petición se perfila, descontándola del contador global"""
+        if not self.vigente or ruta != self.ruta:
+            return False
+        captura = self.captura
+        try:
+            reclamada = await run_in_threadpool(database.claim_profiling_request, captura)
+        except Exception:
+            return False
+        with self._lock:
+            if not reclamada:
+                # Otros workers completaron la captura
+                if self.captura == captura:
+                    self.armado = False
+                return False
+            self.en_curso += 1
+            return True
+
+    def terminar_peticion(self) -> None:
+        with self._lock:
+            self.en_curso -= 1
+
+    def registrar(self, ident: int) -> None:
+        with self._lock:
+            self.hilos[ident] += 1
+
+    def liberar(self, ident: int) -> None:
+        with self._lock:
+            self.hilos[ident] -= 1
+            if self.hilos[ident] <= 0:
+                del self.hilos[ident]
+
+    def _expirada(self) -> bool:
+        return self.expira_en is None or datetime.utcnow() >= self.expira_en
+
+    @property
+    def vigente(self) -> bool:
+        """La captura está armada y no expiró"""
+        return self.armado and not self._expirada()
+
+    @property
+    def activo(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self) -> None:
+        # Muestrear mientras la captura siga vigente o queden peticiones en curso
+        while self.vigente or self.en_curso > 0:
+            frames = sys._current_frames()
+            with self._lock:
+                hilos = list(self.hilos)
+            pilas = [self._plegar(frames[ident]) for ident in hilos if ident in frames]
+            with self._lock:
+                self.pilas.update(pilas)
+                self.muestras += len(pilas)
+            time.sleep(self.intervalo)
+        self._guardar()
+
+    def _guardar(self) -> None:
+        """Guarda las muestras de este worker para combinarlas con las de los demás"""
+        with self._lock:
+            captura, pilas, muestras = self.captura, self.pilas.most_common(), self.muestras
+        if captura is None or muestras == 0:
+            return
+        try:
+            database.save_profiling_samples(captura, worker_id(), [list(pila) for pila in pilas], muestras)
+        except Exception as e:
+            print(f"❌ Error guardando las muestras de profiling: {e}")
+
+    @staticmethod
+    def _plegar(frame) -> str:
+        """Convierte una pila en una línea folded: raiz;...;hoja"""
+        marcos = []
+        while frame is not None:
+            code = frame.f_code
+            marcos.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(marcos))
+
+    def _muestras_por_worker(self) -> Dict[str, Dict[str, Any]]:
+        """Muestras de la captura en curso por worker; las de este worker se toman de memoria"""
+        captura = database.find_profiling_capture()
+        if captura is None:
+            return {}
+        por_worker = {
+            doc["worker"]: {"pilas": Counter(dict(doc["pilas"])), "muestras": doc["muestras"]}
+            for doc in database.find_profiling_samples(captura["captura"])
+        }
+        with self._lock:
+            if self.captura == captura["captura"] and self.muestras:
+                por_worker[worker_id()] = {"pilas": Counter(self.pilas), "muestras": self.muestras}
+        return por_worker
+
+    def folded(self) -> Tuple[str, List[str]]:
+        """Pilas combinadas de todos los workers y los workers que aportaron muestras"""
+        por_worker = self._muestras_por_worker()
+        total: Counter = Counter()
+        for datos in por_worker.values():
+            total.update(datos["pilas"])
+        return "\n".join(f"{pila} {cuenta}" for pila, cuenta in total.most_common()), sorted(por_worker)
+
+    def estado(self) -> Dict[str, Any]:
+        captura = database.find_profiling_capture() or {}
+        por_worker = self._muestras_por_worker() if captura else {}
+        return {
+            "captura": captura.get("captura"),
+            "ruta": captura.get("ruta"),
+            "peticiones": captura.get("peticiones"),
+            "peticiones_restantes": captura.get("restantes", 0),
+            "expira_en": captura.get("expira_en"),
+            "worker": worker_id(),
+            "activo": self.activo,
+            "muestras": sum(datos["muestras"] for datos in por_worker.values()),
+            "workers": {worker: datos["muestras"] for worker, datos in sorted(por_worker.items())}
+        }
+
+profiler = SamplingProfiler()
+
+def verificar_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    """Dependencia que exige la cabecera X-Admin-Token (deshabilitado si ADMIN_TOKEN no está configurado)"""
+    if not ADMIN_TOKEN or not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Acceso restringido")
@@ -0,0 +1,283 @@
+import os
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Callable
+import numpy as np
+
+import database
+
+# ===========================================
+# Reportes analíticos sobre pacientes y citas
+# ===========================================
+# Cada reporte tiene dos motores con la misma salida:
+# - "numpy": lee solo los campos necesarios en bloques y calcula vectorizado
+# - "mongo": pipeline de agregación $group/$bucket ejecutado en el servidor
+# El motor por defecto de cada reporte se elige con variables de entorno según
+# los resultados de benchmarks/benchmark_reportes.py.
+REPORTES_CACHE_TTL = float(os.getenv("REPORTES_CACHE_TTL", "300"))
+REPORTES_BATCH_SIZE = int(os.getenv("REPORTES_BATCH_SIZE", "5000"))
+REPORTES_MOTOR = {
+    "edades": os.getenv("REPORTES_MOTOR_EDADES", "numpy"),
+    "citas_por_doctor": os.getenv("REPORTES_MOTOR_CITAS_POR_DOCTOR", "numpy"),
+    "horas_pico": os.getenv("REPORTES_MOTOR_HORAS_PICO", "numpy")
+}
+
+# Límites de los rangos de edad (en años)
+EDAD_BINS = [0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 130]
+DIAS_POR_ANIO = 365.2425
+MS_POR_ANIO = DIAS_POR_ANIO * 24 * 3600 * 1000
+# Valor del campo opcional "estado" de la cita cuando el paciente no asistió
+ESTADO_NO_ASISTIO = "no_asistio"
+
+# Caché de resultados: {(reporte, motor): (timestamp, resultado)}
+_cache: Dict[Any, Any] = {}
+
+def _a_datetime64(valores: List[Any]) -> np.ndarray:
+    """Convierte fechas (datetime, string ISO o None) a datetime64; las inválidas quedan como NaT"""
+    try:
+        return np.array(valores, dtype="datetime64[ms]")
+    except ValueError:
+        convertidos = []
+        for valor in valores:
+            try:
+                convertidos.append(np.datetime64(valor, "ms"))
+            except (ValueError, TypeError):
+                convertidos.append(np.datetime64("NaT", "ms"))
+        return np.array(convertidos, dtype="datetime64[ms]")
+
+def _columnas(collection_name: str, campos: Dict[str, str], filtro: Optional[Dict[str, Any]] = None) -> Dict[str, np.ndarray]:
+    """Lee solo los campos indicados, en bloques, y los retorna como columnas NumPy.
+
+    campos: {nombre_campo: "datetime" | "str"}
+    """
+    collection = database.get_collection(collection_name, database.resolve_read_profile(None, "export"))
+    projection = {campo: 1 for campo in campos}
+    projection["_id"] = 0
+
+    bloques: Dict[str, List[np.ndarray]] = {campo: [] for campo in campos}
+    buffer: Dict[str, List[Any]] = {campo: [] for campo in campos}
+
+    def volcar():
+        for campo, tipo in campos.items():
+            if tipo == "datetime":
+                bloques[campo].append(_a_datetime64(buffer[campo]))
+            else:
+                bloques[campo].append(np.array(["" if v is None else str(v) for v in buffer[campo]], dtype=str))
+            buffer[campo] = []
+
+    pendientes = 0
+    for doc in collection.find(filtro or {}, projection, batch_size=REPORTES_BATCH_SIZE):
+        for campo in campos:
+            buffer[campo].append(doc.get(campo))
+        pendientes += 1
+        if pendientes == REPORTES_BATCH_SIZE:
+            volcar()
+            pendientes = 0
+    volcar()
+
+    return {campo: np.concatenate(bloques[campo]) for campo in campos}
+
+def _especialidad_por_doctor() -> Dict[str, str]:
+    """Mapa id_doctor -> id_especialidad (la colección de doctores es pequeña).
+
+    Las citas guardan el ID numérico del doctor (id_doctor); las que lo
+    referencian por ObjectId se resuelven por _id, igual que en expand.
+    """
+    collection = database.get_collection("doctor", database.resolve_read_profile(None, "stats"))
+    mapa = {}
+    for doc in collection.find({}, {"id_doctor": 1, "id_especialidad": 1}):
+        especialidad = str(doc.get("id_especialidad", ""))
+        mapa[str(doc["_id"])] = especialidad
+        if doc.get("id_doctor") is not None:
+            mapa[str(doc["id_doctor"])] = especialidad
+    return mapa
+
+# ===========================================
+# Distribución de edades de pacientes
+# ===========================================
+def _formato_edades(conteos: List[int], edades_validas: int, promedio: Optional[float]) -> Dict[str, Any]:
+    return {
+        "rangos": [
+            {"rango": f"{EDAD_BINS[i]}-{EDAD_BINS[i + 1] - 1}", "pacientes": int(conteos[i])}
+            for i in range(len(EDAD_BINS) - 1)
+        ],
+        "total": int(edades_validas),
+        "edad_promedio": round(float(promedio), 1) if promedio is not None else None
+    }
+
+def _edades_numpy() -> Dict[str, Any]:
+    nacimiento = _columnas("paciente", {"fecha_nacimiento": "datetime"})["fecha_nacimiento"]
+    nacimiento = nacimiento[~np.isnat(nacimiento)]
+
+    hoy = np.datetime64(datetime.utcnow(), "ms")
+    edades = np.floor((hoy - nacimiento).astype("timedelta64[D]").astype(np.int64) / DIAS_POR_ANIO)
+    edades = edades[(edades >= EDAD_BINS[0]) & (edades < EDAD_BINS[-1])]
+    conteos, _ = np.histogram(edades, bins=EDAD_BINS)
+
+    return _formato_edades(conteos.tolist(), len(edades), edades.mean() if len(edades) else None)
+
+def _edades_mongo() -> Dict[str, Any]:
+    collection = database.get_collection("paciente", database.resolve_read_profile(None, "stats"))
+    pipeline = [
+        {"$project": {"_id": 0, "edad": {"$floor": {"$divide": [
+            {"$subtract": [datetime.utcnow(), {"$convert": {
+                "input": "$fecha_nacimiento", "to": "date", "onError": None, "onNull": None
+            }}]}, MS_POR_ANIO
+        ]}}}},
+        {"$match": {"edad": {"$gte": EDAD_BINS[0], "$lt": EDAD_BINS[-1]}}},
+        {"$facet": {
+            "rangos": [{"$bucket": {"groupBy": "$edad", "boundaries": EDAD_BINS,
+                                    "output": {"pacientes": {"$sum": 1}}}}],
+            "resumen": [{"$group": {"_id": None, "total": {"$sum": 1}, "promedio": {"$avg": "$edad"}}}]
+        }}
+    ]
+    resultado = next(collection.aggregate(pipeline))
+
+    por_limite = {r["_id"]: r["pacientes"] for r in resultado["rangos"]}
+    conteos = [por_limite.get(limite, 0) for limite in EDAD_BINS[:-1]]
+    resumen = resultado["resumen"][0] if resultado["resumen"] else {"total": 0, "promedio": None}
+    return _formato_edades(conteos, resumen["total"], resumen["promedio"])
+
+# ===========================================
+# Asistencia y no-shows por doctor y especialidad
+# ===========================================
+def _formato_asistencia(ids: List[str], citas: List[int], pasadas: List[int], no_asistio: List[int], clave: str) -> List[Dict[str, Any]]:
+    filas = []
+    for i, id_grupo in enumerate(ids):
+        atendidas = pasadas[i] - no_asistio[i]
+        filas.append({
+            clave: id_grupo,
+            "citas": int(citas[i]),
+            "atendidas": int(atendidas),
+            "no_asistio": int(no_asistio[i]),
+            "tasa_asistencia": round(atendidas / pasadas[i], 4) if pasadas[i] else None,
+            "tasa_no_asistio": round(no_asistio[i] / pasadas[i], 4) if pasadas[i] else None
+        })
+    return sorted(filas, key=lambda fila: fila["citas"], reverse=True)
+
+def _agrupar_por_especialidad(ids_doctor: List[str], citas, pasadas, no_asistio) -> List[Dict[str, Any]]:
+    """Suma los conteos por doctor en conteos por especialidad (vectorizado)"""
+    mapa = _especialidad_por_doctor()
+    especialidades = np.array([mapa.get(id_doctor, "") or "sin_especialidad" for id_doctor in ids_doctor], dtype=str)
+    if len(especialidades) == 0:
+        return []
+    ids, inversos = np.unique(especialidades, return_inverse=True)
+
+    def sumar(valores):
+        return np.bincount(inversos, weights=np.asarray(valores, dtype=np.int64), minlength=len(ids)).astype(np.int64)
+
+    return _formato_asistencia(ids.tolist(), sumar(citas).tolist(), sumar(pasadas).tolist(),
+                               sumar(no_asistio).tolist(), "id_especialidad")
+
+def _citas_por_doctor_numpy() -> Dict[str, Any]:
+    columnas = _columnas("cita", {"id_doctor": "str", "fecha_hora": "datetime", "estado": "str"})
+    ahora = np.datetime64(datetime.utcnow(), "ms")
+
+    ids, inversos = np.unique(columnas["id_doctor"], return_inverse=True)
+    pasadas = columnas["fecha_hora"] < ahora
+    no_asistio = pasadas & (columnas["estado"] == ESTADO_NO_ASISTIO)
+
+    citas = np.bincount(inversos, minlength=len(ids))
+    pasadas = np.bincount(inversos, weights=pasadas, minlength=len(ids)).astype(np.int64)
+    no_asistio = np.bincount(inversos, weights=no_asistio, minlength=len(ids)).astype(np.int64)
+
+    return {
+        "por_doctor": _formato_asistencia(ids.tolist(), citas.tolist(), pasadas.tolist(), no_asistio.tolist(), "id_doctor"),
+        "por_especialidad": _agrupar_por_especialidad(ids.tolist(), citas, pasadas, no_asistio)
+    }
+
+def _citas_por_doctor_mongo() -> Dict[str, Any]:
+    collection = database.get_collection("cita", database.resolve_read_profile(None, "stats"))
+    ahora = datetime.utcnow()
+    pasada = {"$lt": ["$fecha_hora", ahora]}
+    pipeline = [
+        {"$group": {
+            "_id": {"$toString": {"$ifNull": ["$id_doctor", ""]}},
+            "citas": {"$sum": 1},
+            "pasadas": {"$sum": {"$cond": [pasada, 1, 0]}},
+            "no_asistio": {"$sum": {"$cond": [
+                {"$and": [pasada, {"$eq": ["$estado", ESTADO_NO_ASISTIO]}]}, 1, 0
+            ]}}
+        }},
+        {"$sort": {"_id": 1}}
+    ]
+    grupos = list(collection.aggregate(pipeline))
+    ids = [g["_id"] for g in grupos]
+    citas = [g["citas"] for g in grupos]
+    pasadas = [g["pasadas"] for g in grupos]
+    no_asistio = [g["no_asistio"] for g in grupos]
+
+    return {
+        "por_doctor": _formato_asistencia(ids, citas, pasadas, no_asistio, "id_doctor"),
+        "por_especialidad": _agrupar_por_especialidad(ids, citas, pasadas, no_asistio)
+    }
+
+# ===========================================
+# Horas y días con más citas
+# ===========================================
+DIAS_SEMANA = ["lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo"]
+
+def _formato_horas(matriz: np.ndarray) -> Dict[str, Any]:
+    """matriz: 7 x 24 (día de la semana, lunes = 0) x hora del día"""
+    por_hora = matriz.sum(axis=0)
+    return {
+        "por_hora": [{"hora": hora, "citas": int(por_hora[hora])} for hora in range(24)],
+        "por_dia": [{"dia": DIAS_SEMANA[dia], "citas": int(matriz[dia].sum())} for dia in range(7)],
+        "hora_pico": int(por_hora.argmax()) if por_hora.sum() else None,
+        "matriz_dia_hora": matriz.tolist()
+    }
+
+def _horas_pico_numpy() -> Dict[str, Any]:
+    fecha_hora = _columnas("cita", {"fecha_hora": "datetime"})["fecha_hora"]
+    fecha_hora = fecha_hora[~np.isnat(fecha_hora)]
+
+    dias = fecha_hora.astype("datetime64[D]")
+    horas = (fecha_hora.astype("datetime64[h]") - dias).astype(np.int64)
+    # 1970-01-01 fue jueves: desplazar para que lunes = 0
+    dia_semana = (dias.astype(np.int64) + 3) % 7
+
+    matriz = np.bincount(dia_semana * 24 + horas, minlength=7 * 24).reshape(7, 24)
+    return _formato_horas(matriz)
+
+def _horas_pico_mongo() -> Dict[str, Any]:
+    collection = database.get_collection("cita", database.resolve_read_profile(None, "stats"))
+    pipeline = [
+        {"$match": {"fecha_hora": {"$type": "date"}}},
+        {"$group": {
+            "_id": {"dia": {"$dayOfWeek": "$fecha_hora"}, "hora": {"$hour": "$fecha_hora"}},
+            "citas": {"$sum": 1}
+        }}
+    ]
+    matriz = np.zeros((7, 24), dtype=np.int64)
+    for grupo in collection.aggregate(pipeline):
+        # $dayOfWeek: domingo = 1 ... sábado = 7
+        matriz[(grupo["_id"]["dia"] + 5) % 7, grupo["_id"]["hora"]] = grupo["citas"]
+    return _formato_horas(matriz)
+
+# ===========================================
+# API del módulo
+# ===========================================
+MOTORES_REPORTES: Dict[str, Dict[str, Callable[[], Dict[str, Any]]]] = {
+    "edades": {"numpy": _edades_numpy, "mongo": _edades_mongo},
+    "citas_por_doctor": {"numpy": _citas_por_doctor_numpy, "mongo": _citas_por_doctor_mongo},
+    "horas_pico": {"numpy": _horas_pico_numpy, "mongo": _horas_pico_mongo}
+}
+
+@database.db_operation()
+def _calcular(reporte: str, motor: str) -> Dict[str, Any]:
+    return MOTORES_REPORTES[reporte][motor]()
+
+def obtener_reporte(reporte: str, motor: Optional[str] = None) -> Dict[str, Any]:
+    """Calcula (o retorna desde la caché) un reporte con el motor indicado o el configurado"""
+    motor = motor or REPORTES_MOTOR[reporte]
+    clave = (reporte, motor)
+
+    cached = _cache.get(clave)
+    if cached and time.monotonic() - cached[0] < REPORTES_CACHE_TTL:
+        return cached[1]
+
+    resultado = _calcular(reporte, motor)
+
+    resultado = dict(resultado, motor=motor, generado=datetime.utcnow().isoformat())
+    _cache[clave] = (time.monotonic(), resultado)
+    return resultado
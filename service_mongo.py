@@ -1,6 +1,8 @@
+import os
 import database
 from typing import List, Optional, Dict, Any
-from datetime import datetime
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 
 # ===========================================
 # CRUD para Paciente
@@ -32,19 +34,33 @@ def crear_paciente(paciente_data: Dict[str, Any]) -> Optional[str]:
         
         paciente_id = database.insert_document("paciente", paciente_data)
         return paciente_id
+    except database.DatabaseUnavailableError:
+        raise
     except Exception as e:
         print(f"Error creando paciente: {e}")
         return None
 
-def obtener_pacientes() -> List[Dict[str, Any]]:
+def obtener_pacientes(saltar: int = 0, limite: int = 0) -> List[Dict[str, Any]]:
     """Obtener todos los pacientes"""
-    return database.find_documents("paciente")
+    return database.find_documents("paciente", skip=saltar, limit=limite)
+
+def contar_pacientes() -> Optional[int]:
+    """Contar los pacientes"""
+    return database.count_documents("paciente")
 
 def obtener_paciente(paciente_id: str) -> Optional[Dict[str, Any]]:
     """Obtener un paciente por ID"""
     return database.find_document_by_id("paciente", paciente_id)
 
-def actualizar_paciente(paciente_id: str, paciente_data: Dict[str, Any]) -> bool:
+def obtener_cambios_pacientes(desde: Optional[str] = None, limite: int = 100) -> Dict[str, Any]:
+    """Obtener los pacientes modificados o eliminados desde un token de sincronización"""
+    return database.find_changes("paciente", desde, limite)
+
+def obtener_pacientes_por_ids(ids: List[str]) -> Dict[str, Any]:
+    """Obtener varios pacientes por ID (id_paciente o _id) en una sola consulta"""
+    return database.find_documents_by_ids("paciente", ids, key_field="id_paciente")
+
+def actualizar_paciente(paciente_id: str, paciente_data: Dict[str, Any], version_esperada: Optional[int] = None) -> Optional[int]:
     """Actualizar un paciente"""
     try:
         # Convertir fecha_nacimiento a datetime si es date o string
@@ -67,12 +83,17 @@ def actualizar_paciente(paciente_id: str, paciente_data: Dict[str, Any]) -> bool
                         paciente_data['fecha_nacimiento'] = fecha
                     except ValueError:
                         print(f"Error: Formato de fecha inválido: {fecha_valor}")
-                        return False
+                        return None
         
-        return database.update_document("paciente", paciente_id, paciente_data)
+        version = database.update_document("paciente", paciente_id, paciente_data, version_esperada)
+        if version and ('nombre' in paciente_data or 'apellido' in paciente_data):
+            renombrar_paciente_en_agenda(paciente_id)
+        return version
+    except (database.VersionConflictError, database.DatabaseUnavailableError):
+        raise
     except Exception as e:
         print(f"Error actualizando paciente: {e}")
-        return False
+        return None
 
 def eliminar_paciente(paciente_id: str) -> bool:
     """Eliminar un paciente"""
@@ -86,25 +107,41 @@ def crear_especialidad(especialidad_data: Dict[str, Any]) -> Optional[str]:
     try:
         especialidad_id = database.insert_document("especialidades", especialidad_data)
         return especialidad_id
+    except database.DatabaseUnavailableError:
+        raise
     except Exception as e:
         print(f"Error creando especialidad: {e}")
         return None
 
-def obtener_especialidades() -> List[Dict[str, Any]]:
+def obtener_especialidades(saltar: int = 0, limite: int = 0) -> List[Dict[str, Any]]:
     """Obtener todas las especialidades"""
-    return database.find_documents("especialidades")
+    return database.find_documents("especialidades", skip=saltar, limit=limite)
+
+def contar_especialidades() -> Optional[int]:
+    """Contar las especialidades"""
+    return database.count_documents("especialidades")
 
 def obtener_especialidad(especialidad_id: str) -> Optional[Dict[str, Any]]:
     """Obtener una especialidad por ID"""
     return database.find_document_by_id("especialidades", especialidad_id)
 
-def actualizar_especialidad(especialidad_id: str, especialidad_data: Dict[str, Any]) -> bool:
+def obtener_cambios_especialidades(desde: Optional[str] = None, limite: int = 100) -> Dict[str, Any]:
+    """Obtener las especialidades modificadas o eliminadas desde un token de sincronización"""
+    return database.find_changes("especialidades", desde, limite)
+
+def obtener_especialidades_por_ids(ids: List[str]) -> Dict[str, Any]:
+    """Obtener varias especialidades por ID en una sola consulta"""
+    return database.find_documents_by_ids("especialidades", ids)
+
+def actualizar_especialidad(especialidad_id: str, especialidad_data: Dict[str, Any], version_esperada: Optional[int] = None) -> Optional[int]:
     """Actualizar una especialidad"""
     try:
-        return database.update_document("especialidades", especialidad_id, especialidad_data)
+        return database.update_document("especialidades", especialidad_id, especialidad_data, version_esperada)
+    except (database.VersionConflictError, database.DatabaseUnavailableError):
+        raise
     except Exception as e:
         print(f"Error actualizando especialidad: {e}")
-        return False
+        return None
 
 def eliminar_especialidad(especialidad_id: str) -> bool:
     """Eliminar una especialidad"""
@@ -118,25 +155,41 @@ def crear_doctor(doctor_data: Dict[str, Any]) -> Optional[str]:
     try:
         doctor_id = database.insert_document("doctor", doctor_data)
         return doctor_id
+    except database.DatabaseUnavailableError:
+        raise
     except Exception as e:
         print(f"Error creando doctor: {e}")
         return None
 
-def obtener_doctores() -> List[Dict[str, Any]]:
+def obtener_doctores(saltar: int = 0, limite: int = 0) -> List[Dict[str, Any]]:
     """Obtener todos los doctores"""
-    return database.find_documents("doctor")
+    return database.find_documents("doctor", skip=saltar, limit=limite)
+
+def contar_doctores() -> Optional[int]:
+    """Contar los doctores"""
+    return database.count_documents("doctor")
 
 def obtener_doctor(doctor_id: str) -> Optional[Dict[str, Any]]:
     """Obtener un doctor por ID"""
     return database.find_document_by_id("doctor", doctor_id)
 
-def actualizar_doctor(doctor_id: str, doctor_data: Dict[str, Any]) -> bool:
+def obtener_cambios_doctores(desde: Optional[str] = None, limite: int = 100) -> Dict[str, Any]:
+    """Obtener los doctores modificados o eliminados desde un token de sincronización"""
+    return database.find_changes("doctor", desde, limite)
+
+def obtener_doctores_por_ids(ids: List[str]) -> Dict[str, Any]:
+    """Obtener varios doctores por ID (id_doctor o _id) en una sola consulta"""
+    return database.find_documents_by_ids("doctor", ids, key_field="id_doctor")
+
+def actualizar_doctor(doctor_id: str, doctor_data: Dict[str, Any], version_esperada: Optional[int] = None) -> Optional[int]:
     """Actualizar un doctor"""
     try:
-        return database.update_document("doctor", doctor_id, doctor_data)
+        return database.update_document("doctor", doctor_id, doctor_data, version_esperada)
+    except (database.VersionConflictError, database.DatabaseUnavailableError):
+        raise
     except Exception as e:
         print(f"Error actualizando doctor: {e}")
-        return False
+        return None
 
 def eliminar_doctor(doctor_id: str) -> bool:
     """Eliminar un doctor"""
@@ -154,29 +207,45 @@ def crear_historial(historial_data: Dict[str, Any]) -> Optional[str]:
         
         historial_id = database.insert_document("historiales", historial_data)
         return historial_id
+    except database.DatabaseUnavailableError:
+        raise
     except Exception as e:
         print(f"Error creando historial: {e}")
         return None
 
-def obtener_historiales() -> List[Dict[str, Any]]:
+def obtener_historiales(saltar: int = 0, limite: int = 0) -> List[Dict[str, Any]]:
     """Obtener todos los historiales"""
-    return database.find_documents("historiales")
+    return database.find_documents("historiales", skip=saltar, limit=limite)
+
+def contar_historiales() -> Optional[int]:
+    """Contar los historiales"""
+    return database.count_documents("historiales")
 
 def obtener_historial(historial_id: str) -> Optional[Dict[str, Any]]:
     """Obtener un historial por ID"""
     return database.find_document_by_id("historiales", historial_id)
 
-def actualizar_historial(historial_id: str, historial_data: Dict[str, Any]) -> bool:
+def obtener_cambios_historiales(desde: Optional[str] = None, limite: int = 100) -> Dict[str, Any]:
+    """Obtener los historiales modificados o eliminados desde un token de sincronización"""
+    return database.find_changes("historiales", desde, limite)
+
+def obtener_historiales_por_ids(ids: List[str]) -> Dict[str, Any]:
+    """Obtener varios historiales por ID en una sola consulta"""
+    return database.find_documents_by_ids("historiales", ids)
+
+def actualizar_historial(historial_id: str, historial_data: Dict[str, Any], version_esperada: Optional[int] = None) -> Optional[int]:
     """Actualizar un historial"""
     try:
         # Convertir fecha a string si es date
         if hasattr(historial_data, 'fecha'):
             historial_data['fecha'] = str(historial_data['fecha'])
         
-        return database.update_document("historiales", historial_id, historial_data)
+        return database.update_document("historiales", historial_id, historial_data, version_esperada)
+    except (database.VersionConflictError, database.DatabaseUnavailableError):
+        raise
     except Exception as e:
         print(f"Error actualizando historial: {e}")
-        return False
+        return None
 
 def eliminar_historial(historial_id: str) -> bool:
     """Eliminar un historial"""
@@ -188,36 +257,266 @@ def eliminar_historial(historial_id: str) -> bool:
 def crear_cita(cita_data: Dict[str, Any]) -> Optional[str]:
     """Crear una nueva cita"""
     try:
-        # Convertir fecha_hora a string si es datetime
-        if hasattr(cita_data, 'fecha_hora'):
-            cita_data['fecha_hora'] = str(cita_data['fecha_hora'])
+        # Guardar fecha_hora en la hora local de la clínica (ver _hora_clinica)
+        if cita_data.get('fecha_hora') is not None:
+            cita_data['fecha_hora'] = _hora_clinica(cita_data['fecha_hora']) or cita_data['fecha_hora']
         
         cita_id = database.insert_document("cita", cita_data)
+        if cita_id:
+            agregar_cita_a_agenda(cita_id, cita_data)
         return cita_id
+    except database.DatabaseUnavailableError:
+        raise
     except Exception as e:
         print(f"Error creando cita: {e}")
         return None
 
-def obtener_citas() -> List[Dict[str, Any]]:
+def obtener_citas(saltar: int = 0, limite: int = 0) -> List[Dict[str, Any]]:
     """Obtener todas las citas"""
-    return database.find_documents("cita")
+    return database.find_documents("cita", skip=saltar, limit=limite)
+
+def contar_citas() -> Optional[int]:
+    """Contar las citas"""
+    return database.count_documents("cita")
 
 def obtener_cita(cita_id: str) -> Optional[Dict[str, Any]]:
     """Obtener una cita por ID"""
     return database.find_document_by_id("cita", cita_id)
 
-def actualizar_cita(cita_id: str, cita_data: Dict[str, Any]) -> bool:
+def obtener_cambios_citas(desde: Optional[str] = None, limite: int = 100) -> Dict[str, Any]:
+    """Obtener las citas modificadas o eliminadas desde un token de sincronización"""
+    return database.find_changes("cita", desde, limite)
+
+def obtener_citas_por_ids(ids: List[str]) -> Dict[str, Any]:
+    """Obtener varias citas por ID en una sola consulta"""
+    return database.find_documents_by_ids("cita", ids)
+
+def actualizar_cita(cita_id: str, cita_data: Dict[str, Any], version_esperada: Optional[int] = None) -> Optional[int]:
     """Actualizar una cita"""
     try:
-        # Convertir fecha_hora a string si es datetime
-        if hasattr(cita_data, 'fecha_hora'):
-            cita_data['fecha_hora'] = str(cita_data['fecha_hora'])
+        # Guardar fecha_hora en la hora local de la clínica (ver _hora_clinica)
+        if cita_data.get('fecha_hora') is not None:
+            cita_data['fecha_hora'] = _hora_clinica(cita_data['fecha_hora']) or cita_data['fecha_hora']
         
-        return database.update_document("cita", cita_id, cita_data)
+        version = database.update_document("cita", cita_id, cita_data, version_esperada)
+        if version:
+            reubicar_cita_en_agenda(cita_id)
+        return version
+    except (database.VersionConflictError, database.DatabaseUnavailableError):
+        raise
     except Exception as e:
         print(f"Error actualizando cita: {e}")
-        return False
+        return None
 
 def eliminar_cita(cita_id: str) -> bool:
     """Eliminar una cita"""
-    return database.delete_document("cita", cita_id)
+    if not database.delete_document("cita", cita_id):
+        return False
+    try:
+        database.remove_agenda_slot(cita_id)
+    except Exception as e:
+        print(f"Error quitando cita {cita_id} de la agenda: {e}")
+    return True
+
+# Campos que acepta expand: campo de la cita con la referencia, colección y campo con el ID propio de la entidad
+CAMPOS_EXPANDIBLES = {
+    "doctor": ("id_doctor", "doctor"),
+    "paciente": ("id_paciente", "paciente")
+}
+
+def expandir_citas(citas: List[Dict[str, Any]], campos: List[str]) -> Dict[str, List[str]]:
+    """Agregar a cada cita su doctor y/o paciente resolviendo las referencias en lote.
+
+    Las citas guardan el ID numérico de la entidad (id_doctor, id_paciente), que se
+    resuelve contra el campo del mismo nombre; las referencias por ObjectId también
+    se aceptan. Retorna, por campo, las referencias que no existen.
+    """
+    faltantes = {}
+    for campo in campos:
+        campo_id, coleccion = CAMPOS_EXPANDIBLES[campo]
+        encontrados = database.find_documents_by_references(
+            coleccion, campo_id, [cita.get(campo_id) for cita in citas]
+        )
+        
+        for cita in citas:
+            cita[campo] = encontrados.get(str(cita.get(campo_id)))
+        faltantes[campo] = list(dict.fromkeys(
+            str(cita[campo_id]) for cita in citas if cita.get(campo_id) is not None and cita[campo] is None
+        ))
+    
+    return faltantes
+
+# ===========================================
+# Agenda materializada por doctor y día
+# ===========================================
+# Las fallas al mantener la agenda no hacen fallar la escritura de la cita:
+# se registran y reconstruir_agenda() corrige las diferencias.
+# Las citas se guardan en la hora local de la clínica (sin zona horaria): las
+# que llegan con zona se convierten y las que llegan sin zona ya son locales.
+CLINICA_TIMEZONE = ZoneInfo(os.getenv("CLINICA_TIMEZONE", "America/Bogota"))
+
+def _hora_clinica(fecha_hora: Any) -> Optional[datetime]:
+    """Fecha y hora local de la clínica, sin zona horaria (None si no es una fecha)"""
+    if isinstance(fecha_hora, str):
+        try:
+            fecha_hora = datetime.fromisoformat(fecha_hora)
+        except ValueError:
+            return None
+    if not isinstance(fecha_hora, datetime):
+        return None
+    if fecha_hora.tzinfo is not None:
+        fecha_hora = fecha_hora.astimezone(CLINICA_TIMEZONE).replace(tzinfo=None)
+    return fecha_hora
+
+def _dia_agenda(fecha_hora: Any) -> Optional[str]:
+    """Día (YYYY-MM-DD, en la zona horaria de la clínica) al que pertenece una cita"""
+    hora = _hora_clinica(fecha_hora)
+    return hora.date().isoformat() if hora else None
+
+def _nombre_paciente(paciente: Optional[Dict[str, Any]]) -> Optional[str]:
+    if not paciente:
+        return None
+    return f"{paciente.get('nombre', '')} {paciente.get('apellido', '')}".strip()
+
+def _nombres_pacientes(referencias: List[Any]) -> Dict[str, Optional[str]]:
+    """Nombres de los pacientes por la referencia que guarda la cita (leídos del primario)"""
+    pacientes = database.find_documents_by_references("paciente", "id_paciente", referencias, read_profile="primary")
+    return {referencia: _nombre_paciente(paciente) for referencia, paciente in pacientes.items()}
+
+def _slot_agenda(cita_id: str, cita: Dict[str, Any], nombre_paciente: Optional[str]) -> Dict[str, Any]:
+    """Entrada compacta de una cita dentro de la agenda"""
+    return {
+        "id_cita": cita_id,
+        "version": cita.get("version", 0),
+        "fecha_hora": cita.get("fecha_hora"),
+        "motivo": cita.get("motivo"),
+        "id_paciente": str(cita.get("id_paciente")),
+        "paciente": nombre_paciente
+    }
+
+# Pasadas máximas para dejar una cita en su agenda con escrituras concurrentes
+AGENDA_MAX_INTENTOS = 3
+
+def _sincronizar_cita_en_agenda(cita_id: str, cita: Optional[Dict[str, Any]]) -> None:
+    """Dejar una cita en la agenda de su doctor y día, o quitarla si ya no existe.
+    
+    Cada pasada quita las versiones anteriores de la cita, la agrega a su agenda
+    solo si no está y vuelve a leerla: si otra petición la modificó mientras tanto,
+    repite con la versión nueva. Así dos actualizaciones intercaladas no dejan
+    entradas duplicadas ni desactualizadas.
+    """
+    for _ in range(AGENDA_MAX_INTENTOS):
+        if cita is None:
+            database.remove_agenda_slot(cita_id)
+            return
+        
+        version = cita.get("version", 0)
+        database.remove_agenda_slot(cita_id, older_than=version)
+        dia = _dia_agenda(cita.get("fecha_hora"))
+        if dia is not None and cita.get("id_doctor") is not None:
+            nombre = _nombres_pacientes([cita.get("id_paciente")]).get(str(cita.get("id_paciente")))
+            database.add_agenda_slot(str(cita["id_doctor"]), dia, _slot_agenda(cita_id, cita, nombre))
+        
+        actual = database.find_document_by_id("cita", cita_id, read_profile="primary")
+        if actual is not None and actual.get("version", 0) == version:
+            return
+        cita = actual
+    print(f"⚠️  La cita {cita_id} cambió durante la actualización de la agenda; la reconstrucción la corregirá")
+
+def agregar_cita_a_agenda(cita_id: str, cita: Dict[str, Any]) -> None:
+    """Agregar una cita recién creada a la agenda de su doctor y día.
+    
+    Una cita nueva no tiene versiones anteriores en ninguna agenda ni otra
+    petición que la conozca todavía: basta con el nombre del paciente y el
+    $push idempotente, sin la limpieza ni la relectura de las actualizaciones.
+    """
+    try:
+        dia = _dia_agenda(cita.get("fecha_hora"))
+        if dia is None or cita.get("id_doctor") is None:
+            return
+        nombre = _nombres_pacientes([cita.get("id_paciente")]).get(str(cita.get("id_paciente")))
+        database.add_agenda_slot(str(cita["id_doctor"]), dia, _slot_agenda(cita_id, cita, nombre))
+    except Exception as e:
+        print(f"Error agregando cita {cita_id} a la agenda: {e}")
+
+def reubicar_cita_en_agenda(cita_id: str) -> None:
+    """Mover una cita actualizada a la agenda que le corresponde (el doctor o el día pudieron cambiar)"""
+    try:
+        _sincronizar_cita_en_agenda(cita_id, database.find_document_by_id("cita", cita_id, read_profile="primary"))
+    except Exception as e:
+        print(f"Error actualizando cita {cita_id} en la agenda: {e}")
+
+def renombrar_paciente_en_agenda(paciente_id: str) -> None:
+    """Actualizar el nombre desnormalizado del paciente en las agendas"""
+    try:
+        paciente = database.find_document_by_id("paciente", paciente_id, read_profile="primary")
+        nombre = _nombre_paciente(paciente)
+        if nombre:
+            # Las citas referencian al paciente por su id_paciente (o por _id)
+            referencias = [paciente_id]
+            if paciente.get("id_paciente") is not None:
+                referencias.append(str(paciente["id_paciente"]))
+            database.rename_agenda_paciente(referencias, nombre)
+    except Exception as e:
+        print(f"Error actualizando paciente {paciente_id} en la agenda: {e}")
+
+def obtener_agenda(id_doctor: str, fecha: str) -> Dict[str, Any]:
+    """Obtener la agenda de un doctor para un día con una sola lectura por _id"""
+    agenda = database.find_document_by_key(database.AGENDA_COLLECTION, f"{id_doctor}:{fecha}")
+    return agenda or {"_id": f"{id_doctor}:{fecha}", "id_doctor": id_doctor, "fecha": fecha, "citas": []}
+
+def _filtro_dia(dia: str) -> Dict[str, Any]:
+    """Filtro de las citas de un día (hora local de la clínica)"""
+    inicio = datetime.fromisoformat(dia)
+    # Las fechas guardadas como texto se buscan por prefijo, con los días vecinos
+    # por si traen zona horaria; _dia_agenda decide a qué día pertenecen
+    prefijos = "|".join((inicio + timedelta(days=dias)).date().isoformat() for dias in (-1, 0, 1))
+    return {"$or": [
+        {"fecha_hora": {"$gte": inicio, "$lt": inicio + timedelta(days=1)}},
+        {"fecha_hora": {"$regex": f"^({prefijos})"}}
+    ]}
+
+def _reconstruir_dia(dia: str) -> int:
+    """Recalcular las agendas de un día y retornar cuántas quedaron.
+    
+    Las agendas se leen antes que las citas y cada una se reemplaza solo si su
+    revisión no cambió: si una cita se creó, movió o eliminó mientras tanto, su
+    agenda ya no coincide y el día se vuelve a calcular.
+    """
+    for _ in range(AGENDA_MAX_INTENTOS):
+        revisiones = {agenda["_id"]: agenda.get("rev", 0) for agenda in database.find_agendas(dia)}
+        citas = [
+            cita for cita in database.find_documents("cita", _filtro_dia(dia), read_profile="primary")
+            if cita.get("id_doctor") is not None and _dia_agenda(cita.get("fecha_hora")) == dia
+        ]
+        nombres = _nombres_pacientes([cita.get("id_paciente") for cita in citas])
+        
+        agendas: Dict[str, Dict[str, Any]] = {}
+        for cita in citas:
+            id_doctor = str(cita["id_doctor"])
+            agenda = agendas.setdefault(f"{id_doctor}:{dia}", {
+                "_id": f"{id_doctor}:{dia}", "id_doctor": id_doctor, "fecha": dia,
+                "citas": [], "updated_at": datetime.utcnow()
+            })
+            agenda["citas"].append(_slot_agenda(cita["_id"], cita, nombres.get(str(cita.get("id_paciente")))))
+        
+        for agenda in agendas.values():
+            agenda["citas"].sort(key=lambda slot: _hora_clinica(slot["fecha_hora"]))
+        
+        reemplazadas = [
+            database.replace_agenda(clave, agendas.get(clave), revisiones.get(clave))
+            for clave in sorted(set(agendas) | set(revisiones))
+        ]
+        if all(reemplazadas):
+            return len(agendas)
+    print(f"⚠️  Las agendas del {dia} cambiaron durante la reconstrucción; se conservan las escrituras concurrentes")
+    return len(agendas)
+
+def reconstruir_agenda(desde: Optional[str] = None) -> int:
+    """Recalcular las agendas (desde el día indicado, YYYY-MM-DD) a partir de las citas, día por día"""
+    filtro = {"fecha_hora": {"$gte": _hora_clinica(desde)}} if desde else {}
+    dias = database.find_field_keys("cita", "fecha_hora", _dia_agenda, filtro, read_profile="primary")
+    dias.update(database.find_agenda_days(desde))
+    dias.discard(None)
+    
+    return sum(_reconstruir_dia(dia) for dia in sorted(dias) if not desde or dia >= desde)
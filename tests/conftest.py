@@ -0,0 +1,28 @@
+import os
+import sys
+
+import mongomock
+import pytest
+
+# database.py lee la configuración al importarse
+os.environ.setdefault("DB_HOST", "localhost")
+os.environ.setdefault("DB_PORT", "27017")
+os.environ.setdefault("DB_USER", "test")
+os.environ.setdefault("DB_PASSWORD", "test")
+os.environ.setdefault("DB_DATABASE", "clinica_test")
+os.environ.setdefault("CACHE_CHANGE_STREAMS", "false")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "models"))
+
+import database
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """Reemplaza la conexión por un MongoClient en memoria (mongomock) que hace de réplica"""
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(database, "client", client)
+    monkeypatch.setattr(database, "db", client[os.environ["DB_DATABASE"]])
+    database.clear_cache()
+    yield database.db
+    database.clear_cache()
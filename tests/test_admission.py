@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+from pymongo.errors import ExecutionTimeout
+
+import database
+from middleware import AdmissionControlMiddleware, ADMISSION_RETRY_AFTER
+
+CONFIG = {
+    "reads": {"limit": 1, "queue": 0},
+    "writes": {"limit": 1, "queue": 0},
+    "exports": {"limit": 1, "queue": 0}
+}
+
+class AppBloqueada:
+    """App ASGI que no responde hasta que se libera"""
+
+    def __init__(self):
+        self.liberar = asyncio.Event()
+
+    async def __call__(self, scope, receive, send):
+        if scope["path"] != "/health":
+            await self.liberar.wait()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+async def pedir(middleware, path: str):
+    """Retorna (status, cabeceras) de una petición GET"""
+    mensajes = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(mensaje):
+        mensajes.append(mensaje)
+
+    scope = {"type": "http", "method": "GET", "path": path, "headers": [], "query_string": b""}
+    await middleware(scope, receive, send)
+    inicio = mensajes[0]
+    return inicio["status"], {k.decode().lower(): v.decode() for k, v in inicio["headers"]}
+
+def test_descarta_cuando_la_cola_esta_llena():
+    async def escenario():
+        app = AppBloqueada()
+        middleware = AdmissionControlMiddleware(app, config=CONFIG, queue_timeout=5)
+        primera = asyncio.create_task(pedir(middleware, "/paciente"))
+        await asyncio.sleep(0)
+
+        status, cabeceras = await asyncio.wait_for(pedir(middleware, "/doctor"), timeout=1)
+        app.liberar.set()
+        return status, cabeceras, (await primera)[0]
+
+    status, cabeceras, primera = asyncio.run(escenario())
+    assert status == 503
+    assert cabeceras["retry-after"] == ADMISSION_RETRY_AFTER
+    assert primera == 200
+
+def test_descarta_al_agotar_la_espera_en_cola():
+    async def escenario():
+        app = AppBloqueada()
+        config = dict(CONFIG, reads={"limit": 1, "queue": 5})
+        middleware = AdmissionControlMiddleware(app, config=config, queue_timeout=0.05)
+        primera = asyncio.create_task(pedir(middleware, "/paciente"))
+        await asyncio.sleep(0)
+
+        resultado = await pedir(middleware, "/doctor")
+        app.liberar.set()
+        await primera
+        return resultado
+
+    status, cabeceras = asyncio.run(escenario())
+    assert status == 503
+    assert cabeceras["retry-after"] == ADMISSION_RETRY_AFTER
+
+def test_rutas_exentas_no_se_limitan():
+    async def escenario():
+        app = AppBloqueada()
+        middleware = AdmissionControlMiddleware(app, config=CONFIG, queue_timeout=0.05)
+        primera = asyncio.create_task(pedir(middleware, "/paciente"))
+        await asyncio.sleep(0)
+
+        resultado = await pedir(middleware, "/health")
+        app.liberar.set()
+        await primera
+        return resultado
+
+    status, _ = asyncio.run(escenario())
+    assert status == 200
+
+def test_timeout_de_mongodb_no_se_confunde_con_lista_vacia(mongo, monkeypatch):
+    # Un error que no es de disponibilidad conserva el valor por defecto de la operación
+    assert database.find_document_by_id("paciente", "no-es-un-objectid") is None
+
+    def sin_respuesta(collection_name, read_profile=None):
+        raise ExecutionTimeout("operation exceeded time limit")
+
+    monkeypatch.setattr(database, "get_collection", sin_respuesta)
+    with pytest.raises(database.DatabaseUnavailableError):
+        database.find_documents("paciente")
@@ -0,0 +1,106 @@
+from datetime import datetime
+
+from bson import ObjectId
+
+import database
+import service_mongo as service
+
+def _agenda(mongo, clave):
+    return (mongo[database.AGENDA_COLLECTION].find_one({"_id": clave}) or {}).get("citas", [])
+
+def test_agregar_cita_resuelve_el_paciente_por_id_paciente(mongo):
+    mongo.paciente.insert_one({"id_paciente": 7, "nombre": "Ana", "apellido": "Ruiz"})
+    cita = {"_id": ObjectId(), "id_paciente": 7, "id_doctor": 2, "version": 1,
+            "fecha_hora": datetime(2025, 9, 1, 9, 0), "motivo": "Control"}
+    mongo.cita.insert_one(cita)
+
+    service.agregar_cita_a_agenda(str(cita["_id"]), cita)
+    service.agregar_cita_a_agenda(str(cita["_id"]), cita)
+
+    citas = _agenda(mongo, "2:2025-09-01")
+    assert len(citas) == 1
+    assert citas[0]["paciente"] == "Ana Ruiz"
+
+def test_actualizacion_intercalada_no_deja_duplicados(mongo):
+    cita_id = ObjectId()
+    version_1 = {"_id": cita_id, "id_paciente": 7, "id_doctor": 2, "version": 1,
+                 "fecha_hora": datetime(2025, 9, 1, 9, 0), "motivo": "Control"}
+    # Otra petición ya movió la cita de día (versión 2) cuando esta agrega la versión 1
+    mongo.cita.insert_one(dict(version_1, version=2, fecha_hora=datetime(2025, 9, 2, 9, 0)))
+
+    service.agregar_cita_a_agenda(str(cita_id), version_1)
+    service.reubicar_cita_en_agenda(str(cita_id))
+
+    assert _agenda(mongo, "2:2025-09-01") == []
+    citas = _agenda(mongo, "2:2025-09-02")
+    assert [(slot["id_cita"], slot["version"]) for slot in citas] == [(str(cita_id), 2)]
+
+def test_renombrar_paciente_usa_el_id_numerico_y_el_id(mongo, monkeypatch):
+    paciente_id = mongo.paciente.insert_one({"id_paciente": 7, "nombre": "Ana", "apellido": "Ruiz"}).inserted_id
+    # mongomock no implementa array_filters: se verifica con qué referencias se renombra
+    llamadas = []
+    monkeypatch.setattr(database, "rename_agenda_paciente", lambda referencias, nombre: llamadas.append((referencias, nombre)))
+
+    service.renombrar_paciente_en_agenda(str(paciente_id))
+
+    assert llamadas == [([str(paciente_id), "7"], "Ana Ruiz")]
+
+def test_crear_cita_solo_agrega_la_entrada(mongo, monkeypatch):
+    def inesperado(*args, **kwargs):
+        raise AssertionError("una cita nueva no necesita limpieza ni relectura")
+
+    monkeypatch.setattr(database, "remove_agenda_slot", inesperado)
+    monkeypatch.setattr(database, "find_document_by_id", inesperado)
+
+    cita_id = service.crear_cita({"id_paciente": 7, "id_doctor": 2, "fecha_hora": datetime(2025, 9, 1, 9, 0), "motivo": "Control"})
+
+    assert [slot["id_cita"] for slot in _agenda(mongo, "2:2025-09-01")] == [cita_id]
+
+def test_cita_con_zona_horaria_va_al_dia_local_de_la_clinica(mongo, monkeypatch):
+    from zoneinfo import ZoneInfo
+    monkeypatch.setattr(service, "CLINICA_TIMEZONE", ZoneInfo("America/Bogota"))
+
+    cita_id = service.crear_cita({"id_paciente": 7, "id_doctor": 2, "motivo": "Control",
+                                  "fecha_hora": datetime.fromisoformat("2025-09-01T19:00:00-05:00")})
+    assert [slot["id_cita"] for slot in _agenda(mongo, "2:2025-09-01")] == [cita_id]
+    assert _agenda(mongo, "2:2025-09-02") == []
+
+    # Se guarda en hora local, así que al releerla sigue en el mismo día
+    assert service.actualizar_cita(cita_id, {"motivo": "Control anual"}) == 2
+    assert [slot["motivo"] for slot in _agenda(mongo, "2:2025-09-01")] == ["Control anual"]
+    assert mongo.cita.find_one()["fecha_hora"] == datetime(2025, 9, 1, 19, 0)
+
+def _cita(id_doctor, fecha_hora, **campos):
+    return dict({"id_paciente": 7, "id_doctor": id_doctor, "fecha_hora": fecha_hora, "motivo": "Control"}, **campos)
+
+def test_reconstruir_agenda_por_dia(mongo):
+    primera = service.crear_cita(_cita(2, datetime(2025, 9, 1, 10, 0)))
+    segunda = service.crear_cita(_cita(2, datetime(2025, 9, 1, 9, 0)))
+    mongo[database.AGENDA_COLLECTION].delete_many({})
+    mongo[database.AGENDA_COLLECTION].insert_one({"_id": "3:2025-09-02", "id_doctor": "3", "fecha": "2025-09-02",
+                                                  "citas": [{"id_cita": "borrada"}]})
+    mongo[database.AGENDA_COLLECTION].insert_one({"_id": "3:2025-08-01", "id_doctor": "3", "fecha": "2025-08-01",
+                                                  "citas": [{"id_cita": "anterior"}]})
+
+    assert service.reconstruir_agenda("2025-09-01") == 1
+
+    assert [slot["id_cita"] for slot in _agenda(mongo, "2:2025-09-01")] == [segunda, primera]
+    assert mongo[database.AGENDA_COLLECTION].find_one({"_id": "3:2025-09-02"}) is None
+    # Los días anteriores a desde no se tocan
+    assert _agenda(mongo, "3:2025-08-01") == [{"id_cita": "anterior"}]
+
+def test_reconstruir_agenda_conserva_citas_creadas_durante_la_reconstruccion(mongo, monkeypatch):
+    existente = service.crear_cita(_cita(2, datetime(2025, 9, 1, 9, 0)))
+    find_documents = database.find_documents
+    creadas = []
+
+    def crear_durante_la_lectura(collection_name, *args, **kwargs):
+        documentos = find_documents(collection_name, *args, **kwargs)
+        if collection_name == "cita" and not creadas:
+            creadas.append(service.crear_cita(_cita(2, datetime(2025, 9, 1, 11, 0))))
+        return documentos
+
+    monkeypatch.setattr(database, "find_documents", crear_durante_la_lectura)
+    service.reconstruir_agenda()
+
+    assert [slot["id_cita"] for slot in _agenda(mongo, "2:2025-09-01")] == [existente] + creadas
@@ -0,0 +1,46 @@
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pytest
+
+import database
+from batch_writer import GroupCommitWriter
+
+class ColeccionLenta:
+    """Colección cuyo primer insert_many queda bloqueado hasta liberarla"""
+
+    def __init__(self):
+        self.liberar = threading.Event()
+        self.insertados = []
+
+    def insert_many(self, documents, ordered=False):
+        self.liberar.wait(5)
+        for i, document in enumerate(documents):
+            document["_id"] = f"{len(self.insertados)}-{i}"
+        self.insertados.extend(documents)
+
+def test_documento_que_agota_el_tiempo_no_se_inserta():
+    coleccion = ColeccionLenta()
+    writer = GroupCommitWriter(lambda: coleccion, max_docs=1, max_delay_ms=0)
+    primero = threading.Thread(target=writer.insert, args=({"n": 1},))
+    primero.start()
+
+    # El hilo de fondo está ocupado con el primer lote: el segundo sigue en la cola
+    with pytest.raises(FutureTimeoutError):
+        writer.insert({"n": 2}, timeout=0.05)
+
+    coleccion.liberar.set()
+    primero.join(5)
+    writer.insert({"n": 3})
+    assert [document["n"] for document in coleccion.insertados] == [1, 3]
+
+def test_insert_document_reporta_el_timeout_como_no_disponible(mongo, monkeypatch):
+    class WriterSinRespuesta:
+        def insert(self, document):
+            raise FutureTimeoutError()
+
+    monkeypatch.setattr(database, "BATCH_INSERT_COLLECTIONS", {"cita"})
+    monkeypatch.setattr(database, "get_batch_writer", lambda collection_name: WriterSinRespuesta())
+
+    with pytest.raises(database.DatabaseUnavailableError):
+        database.insert_document("cita", {"motivo": "Control"})
@@ -0,0 +1,98 @@
+import threading
+
+import pytest
+from pymongo.errors import AutoReconnect, OperationFailure
+
+import cache_watcher
+import database
+
+class FakeStream:
+    """Change stream de una réplica: entrega los eventos y luego falla o espera"""
+
+    def __init__(self, eventos, error=None):
+        self.eventos = list(eventos)
+        self.error = error
+        self.alive = True
+        self.resume_token = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.alive = False
+
+    def try_next(self):
+        if self.eventos:
+            evento = self.eventos.pop(0)
+            self.resume_token = evento["_id"]
+            return evento
+        if self.error:
+            raise self.error
+        return None
+
+class FakeDatabase:
+    def __init__(self, streams=None, error=None):
+        self.streams = list(streams or [])
+        self.error = error
+        self.resume_after = []
+        self.watching = threading.Event()
+
+    def watch(self, pipeline, resume_after=None, max_await_time_ms=None):
+        self.resume_after.append(resume_after)
+        if self.error:
+            raise self.error
+        if len(self.streams) == 1:
+            self.watching.set()
+        return self.streams.pop(0) if len(self.streams) > 1 else self.streams[0]
+
+def evento(coleccion, documento_id, token):
+    return {"_id": {"_data": token}, "ns": {"coll": coleccion}, "documentKey": {"_id": documento_id}}
+
+@pytest.fixture
+def watcher(monkeypatch):
+    monkeypatch.setattr(cache_watcher, "RETRY_SECONDS", 0.01)
+    watcher = cache_watcher.CacheInvalidationWatcher()
+    yield watcher
+    watcher.stop()
+
+def test_standalone_queda_en_modo_solo_ttl(watcher, monkeypatch):
+    error = OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+    monkeypatch.setattr(database, "get_database", lambda: FakeDatabase(error=error))
+
+    watcher.start()
+    watcher._thread.join(timeout=1)
+
+    assert not watcher._thread.is_alive()
+    assert watcher.mode == "ttl"
+
+def test_modo_solo_ttl_expira_la_cache(mongo, monkeypatch):
+    doctor_id = mongo.doctor.insert_one({"nombre": "Ana"}).inserted_id
+    assert database.find_document_by_id("doctor", str(doctor_id))["nombre"] == "Ana"
+
+    # Otro worker escribe: sin change streams solo el TTL refresca la lectura
+    mongo.doctor.update_one({"_id": doctor_id}, {"$set": {"nombre": "Beatriz"}})
+    assert database.find_document_by_id("doctor", str(doctor_id))["nombre"] == "Ana"
+
+    monkeypatch.setattr(database, "READ_CACHE_TTL", 0)
+    assert database.find_document_by_id("doctor", str(doctor_id))["nombre"] == "Beatriz"
+
+def test_invalida_la_cache_y_reanuda_con_el_resume_token(watcher, monkeypatch):
+    primero = FakeStream([evento("doctor", "d1", "t1")], error=AutoReconnect("conexión perdida"))
+    segundo = FakeStream([evento("especialidades", "e1", "t2")])
+    fake_db = FakeDatabase(streams=[primero, segundo])
+    monkeypatch.setattr(database, "get_database", lambda: fake_db)
+
+    invalidados = []
+    monkeypatch.setattr(database, "invalidate_cache", lambda coleccion, documento_id: invalidados.append((coleccion, documento_id)))
+
+    watcher.start()
+    assert fake_db.watching.wait(timeout=1)
+    for _ in range(100):
+        if len(invalidados) == 2:
+            break
+        threading.Event().wait(0.01)
+
+    assert invalidados == [("doctor", "d1"), ("especialidades", "e1")]
+    # Tras el error de red se reanuda desde el último evento procesado
+    assert fake_db.resume_after[:2] == [None, {"_data": "t1"}]
+    assert watcher.mode == "change_streams"
@@ -0,0 +1,26 @@
+import service_mongo as service
+
+def test_expand_resuelve_ids_numericos_y_reporta_faltantes(mongo):
+    mongo.paciente.insert_one({"id_paciente": 7, "nombre": "Ana", "apellido": "Ruiz"})
+    doctor_id = mongo.doctor.insert_one({"id_doctor": 2, "nombre": "Luis", "apellido": "Mora"}).inserted_id
+    citas = [
+        {"_id": "c1", "id_paciente": 7, "id_doctor": 2},
+        {"_id": "c2", "id_paciente": 99, "id_doctor": str(doctor_id)}
+    ]
+
+    faltantes = service.expandir_citas(citas, ["doctor", "paciente"])
+
+    assert citas[0]["paciente"]["nombre"] == "Ana"
+    assert citas[0]["doctor"]["nombre"] == "Luis"
+    assert citas[1]["doctor"]["nombre"] == "Luis"
+    assert citas[1]["paciente"] is None
+    assert faltantes == {"doctor": [], "paciente": ["99"]}
+
+def test_batch_get_resuelve_ids_numericos_en_orden(mongo):
+    mongo.doctor.insert_one({"id_doctor": 2, "nombre": "Luis", "apellido": "Mora"})
+    doctor_id = str(mongo.doctor.insert_one({"id_doctor": 5, "nombre": "Eva", "apellido": "Paz"}).inserted_id)
+
+    resultado = service.obtener_doctores_por_ids(["5", "99", "2", doctor_id])
+
+    assert [doctor["nombre"] for doctor in resultado["documents"]] == ["Eva", "Luis", "Eva"]
+    assert resultado["missing"] == ["99"]
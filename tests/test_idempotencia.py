@@ -0,0 +1,95 @@
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+import database
+import middleware
+import service_mongo as service
+
+@pytest.fixture
+def client(mongo):
+    import main
+    return TestClient(main.app)
+
+def _hash(cuerpo):
+    return hashlib.sha256(json.dumps(cuerpo).encode()).hexdigest()
+
+def test_reintento_repite_la_respuesta_sin_insertar(client, mongo):
+    cuerpo = {"nombre": "Cardiología"}
+    primera = client.post("/especialidad", json=cuerpo, headers={"Idempotency-Key": "k1"})
+    segunda = client.post("/especialidad", json=cuerpo, headers={"Idempotency-Key": "k1"})
+
+    assert primera.status_code == segunda.status_code == 200
+    assert segunda.headers["Idempotent-Replayed"] == "true"
+    assert segunda.json()["id_especialidad"] == primera.json()["id_especialidad"]
+    assert mongo.especialidades.count_documents({}) == 1
+
+def test_error_de_validacion_no_se_guarda(client, mongo):
+    invalida = client.post("/especialidad", json={"nombre": "X"}, headers={"Idempotency-Key": "k1"})
+    corregida = client.post("/especialidad", json={"nombre": "Cardiología"}, headers={"Idempotency-Key": "k1"})
+
+    assert invalida.status_code == 422
+    assert corregida.status_code == 200
+    assert "Idempotent-Replayed" not in corregida.headers
+    assert mongo.especialidades.count_documents({}) == 1
+
+def test_misma_clave_con_otro_cuerpo_responde_422(client, mongo):
+    client.post("/especialidad", json={"nombre": "Cardiología"}, headers={"Idempotency-Key": "k1"})
+    otra = client.post("/especialidad", json={"nombre": "Neurología"}, headers={"Idempotency-Key": "k1"})
+
+    assert otra.status_code == 422
+    assert mongo.especialidades.count_documents({}) == 1
+
+def test_peticiones_concurrentes_con_la_misma_clave_insertan_una_vez(client, mongo, monkeypatch):
+    crear = service.crear_especialidad
+
+    def crear_lento(datos):
+        time.sleep(0.2)
+        return crear(datos)
+
+    monkeypatch.setattr(service, "crear_especialidad", crear_lento)
+    respuestas = []
+
+    def enviar():
+        respuestas.append(client.post("/especialidad", json={"nombre": "Cardiología"},
+                                      headers={"Idempotency-Key": "k1"}))
+
+    hilos = [threading.Thread(target=enviar) for _ in range(2)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join(5)
+
+    assert [respuesta.status_code for respuesta in respuestas] == [200, 200]
+    assert sorted(respuesta.headers.get("Idempotent-Replayed", "") for respuesta in respuestas) == ["", "true"]
+    assert mongo.especialidades.count_documents({}) == 1
+
+def test_reserva_en_curso_responde_409_al_agotar_la_espera(client, mongo, monkeypatch):
+    monkeypatch.setattr(middleware, "IDEMPOTENCY_WAIT_SECONDS", 0.1)
+    cuerpo = {"nombre": "Cardiología"}
+    mongo[database.IDEMPOTENCY_COLLECTION].insert_one(
+        {"_id": "/especialidad:k1", "estado": "en_curso", "hash": _hash(cuerpo), "created_at": datetime.utcnow()}
+    )
+
+    respuesta = client.post("/especialidad", content=json.dumps(cuerpo),
+                            headers={"Idempotency-Key": "k1", "Content-Type": "application/json"})
+    assert respuesta.status_code == 409
+    assert mongo.especialidades.count_documents({}) == 0
+
+def test_reserva_abandonada_se_toma(client, mongo):
+    cuerpo = {"nombre": "Cardiología"}
+    abandonada = datetime.utcnow() - timedelta(seconds=database.IDEMPOTENCY_LOCK_SECONDS + 1)
+    mongo[database.IDEMPOTENCY_COLLECTION].insert_one(
+        {"_id": "/especialidad:k1", "estado": "en_curso", "hash": _hash(cuerpo), "created_at": abandonada}
+    )
+
+    respuesta = client.post("/especialidad", content=json.dumps(cuerpo),
+                            headers={"Idempotency-Key": "k1", "Content-Type": "application/json"})
+    assert respuesta.status_code == 200
+    assert "Idempotent-Replayed" not in respuesta.headers
+    assert mongo[database.IDEMPOTENCY_COLLECTION].find_one({"_id": "/especialidad:k1"})["estado"] == "completada"
@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+import database
+import profiling
+
+@pytest.fixture
+def admin(mongo, monkeypatch):
+    import main
+    monkeypatch.setattr(profiling, "ADMIN_TOKEN", "secreto")
+    return TestClient(main.app, headers={"X-Admin-Token": "secreto"})
+
+def test_armar_ruta_desconocida_responde_400(admin):
+    respuesta = admin.post("/admin/profiling", params={"ruta": "/citas/{cita_id}"})
+    assert respuesta.status_code == 400
+    assert database.find_profiling_capture() is None
+
+def test_captura_expirada_no_perfila(mongo, monkeypatch):
+    profiler = profiling.SamplingProfiler()
+    monkeypatch.setattr(profiling, "PROFILING_MAX_SECONDS", 60)
+    profiler.armar("/cita/{cita_id}", 10, 5)
+    assert profiler.vigente
+
+    vencida = datetime.utcnow() - timedelta(seconds=1)
+    mongo[database.PROFILING_COLLECTION].update_one({"_id": "actual"}, {"$set": {"expira_en": vencida}})
+    profiler._adoptar(database.find_profiling_capture())
+
+    assert not profiler.vigente
+    assert database.claim_profiling_request(profiler.captura) is False
+    profiler._thread.join(1)
+    assert not profiler.activo
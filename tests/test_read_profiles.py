@@ -0,0 +1,73 @@
+import pytest
+from fastapi.testclient import TestClient
+from pymongo.read_preferences import Primary, Secondary, SecondaryPreferred, Nearest
+
+import database
+
+def test_modos_de_lectura_con_max_staleness(monkeypatch):
+    monkeypatch.setitem(database.READ_PROFILES_CONFIG, "list", {"mode": "secondary", "read_concern": "majority"})
+    monkeypatch.setitem(database.READ_PROFILES_CONFIG, "stats", {"mode": "nearest", "read_concern": "local"})
+
+    opciones = database.get_read_options("list")
+    assert isinstance(opciones["read_preference"], Secondary)
+    assert opciones["read_preference"].max_staleness == database.READ_MAX_STALENESS
+    assert opciones["read_concern"].level == "majority"
+
+    assert isinstance(database.get_read_options("stats")["read_preference"], Nearest)
+    assert isinstance(database.get_read_options("primary")["read_preference"], Primary)
+
+def test_modo_invalido_falla_al_validar(monkeypatch):
+    monkeypatch.setitem(database.READ_PROFILES_CONFIG, "list", {"mode": "secundario", "read_concern": "local"})
+    with pytest.raises(ValueError, match="Modo de lectura inválido"):
+        database._validate_read_profiles()
+
+def test_ruta_con_perfil_desconocido_falla_al_validar(monkeypatch):
+    monkeypatch.setitem(database.ROUTE_READ_PROFILES, "GET /cita", "analitica")
+    with pytest.raises(ValueError, match="Perfil de lectura desconocido"):
+        database._validate_read_profiles()
+
+def test_prioridad_explicito_ruta_operacion():
+    assert database.resolve_read_profile(None, "list") == "list"
+    token = database.set_route_read_profile("GET", "/agenda/{id_doctor}/{fecha}")
+    try:
+        assert database.resolve_read_profile(None, "list") == "primary"
+        assert database.resolve_read_profile("stats", "list") == "stats"
+    finally:
+        database.reset_route_read_profile(token)
+    assert database.resolve_read_profile(None, "list") == "list"
+
+@pytest.fixture
+def perfiles_usados(mongo, monkeypatch):
+    """Registra la read preference de cada colección que abre la capa de datos"""
+    usados = []
+    get_collection = database.get_collection
+
+    def espiar(collection_name, read_profile=None):
+        collection = get_collection(collection_name, read_profile)
+        usados.append((collection_name, read_profile, collection.read_preference))
+        return collection
+
+    monkeypatch.setattr(database, "get_collection", espiar)
+    return usados
+
+def test_perfil_por_ruta_en_la_api(perfiles_usados, mongo):
+    import main
+
+    paciente_id = str(mongo.paciente.insert_one({"nombre": "Ana", "apellido": "López"}).inserted_id)
+    client = TestClient(main.app)
+
+    assert client.get("/paciente").status_code == 200
+    assert {perfil for _, perfil, _ in perfiles_usados} == {"list"}
+    assert all(isinstance(pref, SecondaryPreferred) for _, _, pref in perfiles_usados)
+
+    perfiles_usados.clear()
+    assert client.get(f"/paciente/{paciente_id}").status_code == 200
+    assert [perfil for _, perfil, _ in perfiles_usados] == ["primary"]
+    assert isinstance(perfiles_usados[0][2], Primary)
+
+def test_perfil_de_ruta_configurable(perfiles_usados, monkeypatch):
+    import main
+
+    monkeypatch.setitem(database.ROUTE_READ_PROFILES, "GET /paciente", "primary")
+    assert TestClient(main.app).get("/paciente", params={"incluir_total": False}).status_code == 200
+    assert [perfil for _, perfil, _ in perfiles_usados] == ["primary"]
@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import reportes
+
+@pytest.mark.parametrize("motor", ["numpy", "mongo"])
+def test_citas_por_especialidad_con_id_doctor_numerico(mongo, motor):
+    mongo.doctor.insert_one({"id_doctor": 5, "id_especialidad": 3})
+    doctor_oid = mongo.doctor.insert_one({"id_doctor": 6, "id_especialidad": 4}).inserted_id
+    pasada = datetime.utcnow() - timedelta(days=1)
+    mongo.cita.insert_many([
+        {"id_doctor": 5, "fecha_hora": pasada, "estado": "no_asistio"},
+        {"id_doctor": 5, "fecha_hora": pasada},
+        {"id_doctor": str(doctor_oid), "fecha_hora": pasada},
+        {"id_doctor": 99, "fecha_hora": pasada}
+    ])
+    reportes._cache.clear()
+
+    por_especialidad = {
+        fila["id_especialidad"]: fila
+        for fila in reportes.obtener_reporte("citas_por_doctor", motor)["por_especialidad"]
+    }
+
+    assert set(por_especialidad) == {"3", "4", "sin_especialidad"}
+    assert por_especialidad["3"]["citas"] == 2
+    assert por_especialidad["3"]["no_asistio"] == 1
+    assert por_especialidad["4"]["citas"] == 1
+    assert por_especialidad["sin_especialidad"]["citas"] == 1
@@ -0,0 +1,75 @@
+import base64
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId, Timestamp
+
+import database
+
+def test_token_conserva_la_posicion():
+    posicion = {"documents": [Timestamp(1700000000, 3), ObjectId()], "tombstones": [None, None]}
+    assert database.decode_sync_token(database.encode_sync_token(posicion)) == posicion
+
+def test_token_anterior_a_la_retencion_de_tombstones_expira():
+    token = database.encode_sync_token({"documents": [None, None], "tombstones": [None, None]})
+    data = json.loads(base64.urlsafe_b64decode(token))
+    data["issued"] = (datetime.utcnow() - timedelta(days=database.TOMBSTONE_TTL_DAYS + 1)).isoformat()
+    with pytest.raises(database.SyncTokenExpiredError):
+        database.decode_sync_token(base64.urlsafe_b64encode(json.dumps(data).encode()).decode())
+
+def test_token_invalido():
+    with pytest.raises(ValueError):
+        database.decode_sync_token("no-es-un-token")
+
+def test_eliminar_no_reporta_falla_si_solo_falla_el_tombstone(mongo, monkeypatch):
+    documento_id = str(mongo.paciente.insert_one({"nombre": "Ana"}).inserted_id)
+
+    def fallar(*args, **kwargs):
+        raise RuntimeError("tombstones no disponible")
+
+    monkeypatch.setattr(database, "_insert_tombstone", fallar)
+    assert database.delete_document("paciente", documento_id) is True
+    assert mongo.paciente.count_documents({}) == 0
+
+def test_eliminar_registra_tombstone_con_marca_del_servidor(mongo):
+    documento_id = str(mongo.paciente.insert_one({"nombre": "Ana"}).inserted_id)
+    assert database.delete_document("paciente", documento_id) is True
+    tombstone = mongo[database.TOMBSTONES_COLLECTION].find_one({"document_id": documento_id})
+    assert isinstance(tombstone["sync_ts"], Timestamp) and tombstone["sync_ts"] != Timestamp(0, 0)
+
+@pytest.fixture
+def cambios(mongo, monkeypatch):
+    """mongomock no ordena Timestamps ni implementa hello: se le da el orden BSON
+    (después de Date) y se fija el límite superior de la sincronización"""
+    import mongomock.filtering
+
+    get_compare_type = mongomock.filtering._get_compare_type
+    monkeypatch.setattr(mongomock.filtering, "_get_compare_type",
+                        lambda val: 47 if isinstance(val, Timestamp) else get_compare_type(val))
+    monkeypatch.setattr(database, "_sync_upper_bound", lambda: Timestamp(2 ** 31 - 1, 0))
+    return mongo
+
+def test_cambios_paginados_con_documentos_antiguos_y_eliminaciones(cambios):
+    antiguo = str(cambios.paciente.insert_one({"nombre": "Sin marca"}).inserted_id)
+    ids = [database.insert_document("paciente", {"nombre": nombre}) for nombre in ("Ana", "Luis", "Eva")]
+
+    primera = database.find_changes("paciente", limit=2)
+    assert [doc["_id"] for doc in primera["documents"]] == [antiguo, ids[0]]
+    assert primera["has_more"] is True
+    assert all("sync_ts" not in doc for doc in primera["documents"])
+
+    segunda = database.find_changes("paciente", primera["token"], limit=2)
+    assert [doc["_id"] for doc in segunda["documents"]] == ids[1:]
+
+    tercera = database.find_changes("paciente", segunda["token"], limit=2)
+    assert tercera["documents"] == [] and tercera["deleted"] == []
+    assert tercera["has_more"] is False
+
+    database.update_document("paciente", ids[0], {"nombre": "Ana María"})
+    assert database.delete_document("paciente", ids[1]) is True
+
+    cuarta = database.find_changes("paciente", tercera["token"], limit=2)
+    assert [doc["nombre"] for doc in cuarta["documents"]] == ["Ana María"]
+    assert cuarta["deleted"] == [ids[1]]
+    assert cuarta["has_more"] is False
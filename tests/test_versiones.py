@@ -0,0 +1,47 @@
+import pytest
+from fastapi.testclient import TestClient
+
+@pytest.fixture
+def client(mongo):
+    import main
+    return TestClient(main.app)
+
+@pytest.fixture
+def especialidad_id(client):
+    respuesta = client.post("/especialidad", json={"nombre": "Cardiología"})
+    assert respuesta.status_code == 200
+    return respuesta.json()["id_especialidad"]
+
+def test_lectura_por_id_envia_etag(client, especialidad_id):
+    respuesta = client.get(f"/especialidad/{especialidad_id}")
+    assert respuesta.headers["ETag"] == '"1"'
+
+def test_actualizacion_incrementa_la_version(client, especialidad_id):
+    respuesta = client.put(f"/especialidad/{especialidad_id}", json={"nombre": "Cardiología infantil"},
+                           headers={"If-Match": '"1"'})
+    assert respuesta.status_code == 200
+    assert respuesta.json()["version"] == 2
+    assert respuesta.headers["ETag"] == '"2"'
+    assert client.get(f"/especialidad/{especialidad_id}").headers["ETag"] == '"2"'
+
+def test_version_desactualizada_responde_409(client, especialidad_id):
+    assert client.put(f"/especialidad/{especialidad_id}", json={"nombre": "Neurología"},
+                      headers={"If-Match": '"1"'}).status_code == 200
+
+    respuesta = client.put(f"/especialidad/{especialidad_id}", json={"nombre": "Neumología"},
+                           headers={"If-Match": '"1"'})
+    assert respuesta.status_code == 409
+    assert client.get(f"/especialidad/{especialidad_id}").json()["data"]["nombre"] == "Neurología"
+
+def test_if_match_asterisco_no_verifica_version(client, especialidad_id):
+    client.put(f"/especialidad/{especialidad_id}", json={"nombre": "Neurología"})
+
+    respuesta = client.patch(f"/especialidad/{especialidad_id}", json={"descripcion": "Sistema nervioso"},
+                             headers={"If-Match": "*"})
+    assert respuesta.status_code == 200
+    assert respuesta.json()["version"] == 3
+
+def test_if_match_asterisco_con_documento_inexistente_responde_404(client):
+    respuesta = client.patch("/especialidad/64b000000000000000000000", json={"descripcion": "x"},
+                             headers={"If-Match": "*"})
+    assert respuesta.status_code == 404